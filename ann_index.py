@@ -0,0 +1,153 @@
+import os
+import json
+import math
+import numpy as np
+import faiss
+from typing import Dict, Any, Optional
+from config import (
+    INDEX_MMAP, INDEX_TYPE, IVF_NLIST, IVF_NPROBE, PQ_M, PQ_NBITS, HNSW_M, HNSW_EF_CONSTRUCTION, HNSW_EF_SEARCH
+)
+
+# Index factory for the configurable FAISS index types. Every index is wrapped
+# in IndexIDMap2 so labels are image_ids whatever the underlying structure.
+
+INDEX_TYPES = ('flat', 'ivf_flat', 'ivf_pq', 'hnsw')
+
+def index_params_from_config() -> Dict[str, Any]:
+    if INDEX_TYPE not in INDEX_TYPES:
+        raise ValueError(f"INDEX_TYPE must be one of {INDEX_TYPES}, got '{INDEX_TYPE}'")
+
+    return {
+        'index_type': INDEX_TYPE,
+        'nlist': IVF_NLIST,
+        'nprobe': IVF_NPROBE,
+        'pq_m': PQ_M,
+        'pq_nbits': PQ_NBITS,
+        'hnsw_m': HNSW_M,
+        'ef_construction': HNSW_EF_CONSTRUCTION,
+        'ef_search': HNSW_EF_SEARCH
+    }
+
+def needs_training(params: Dict[str, Any]) -> bool:
+    return params['index_type'] in ('ivf_flat', 'ivf_pq')
+
+def default_nlist(count: int) -> int:
+    # ~4*sqrt(n) lists, while keeping at least 39 training points per centroid.
+    return max(1, min(int(4 * math.sqrt(count)), count // 39))
+
+def create_index(dimension: int, params: Dict[str, Any], count: int) -> faiss.Index:
+    index_type = params['index_type']
+
+    if index_type == 'flat':
+        base = faiss.IndexFlatL2(dimension)
+    elif index_type in ('ivf_flat', 'ivf_pq'):
+        if not params.get('nlist'):
+            params['nlist'] = default_nlist(count)
+        quantizer = faiss.IndexFlatL2(dimension)
+        if index_type == 'ivf_flat':
+            base = faiss.IndexIVFFlat(quantizer, dimension, params['nlist'])
+        else:
+            if dimension % params['pq_m'] != 0:
+                raise ValueError(f"PQ_M={params['pq_m']} must divide the vector dimension {dimension}")
+            base = faiss.IndexIVFPQ(quantizer, dimension, params['nlist'], params['pq_m'], params['pq_nbits'])
+        base.nprobe = params['nprobe']
+    elif index_type == 'hnsw':
+        base = faiss.IndexHNSWFlat(dimension, params['hnsw_m'])
+        base.hnsw.efConstruction = params['ef_construction']
+        base.hnsw.efSearch = params['ef_search']
+    else:
+        raise ValueError(f"Unknown index type '{index_type}'")
+
+    return faiss.IndexIDMap2(base)
+
+def train_index(index: faiss.Index, vectors: np.ndarray):
+    faiss.downcast_index(index.index).train(np.ascontiguousarray(vectors, dtype=np.float32))
+
+def inner_index(index: faiss.Index) -> faiss.Index:
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        return faiss.downcast_index(index.index)
+    return index
+
+def product_centroid_index(vectors: np.ndarray, positions: np.ndarray, product_ids: np.ndarray,
+                           chunk_size: int = 50000) -> faiss.Index:
+    # Mean image vector per product, labelled with product_id. Rows are visited
+    # grouped by product so each chunk is summed with one reduceat.
+    products, groups = np.unique(product_ids, return_inverse=True)
+    order = np.argsort(groups, kind='stable')
+    sums = np.zeros((len(products), vectors.shape[1]), dtype=np.float64)
+
+    for start in range(0, len(order), chunk_size):
+        chunk = order[start:start + chunk_size]
+        chunk_groups = groups[chunk]
+        starts = np.flatnonzero(np.r_[True, chunk_groups[1:] != chunk_groups[:-1]])
+        sums[chunk_groups[starts]] += np.add.reduceat(vectors[positions[chunk]].astype(np.float64), starts)
+
+    centroids = (sums / np.bincount(groups)[:, None]).astype(np.float32)
+    index = faiss.IndexIDMap2(faiss.IndexFlatL2(vectors.shape[1]))
+    index.add_with_ids(centroids, products)
+    return index
+
+def enable_reconstruct(index: faiss.Index):
+    # IVF indexes need a direct map before reconstruct(); other types have one.
+    base = inner_index(index)
+    if isinstance(base, faiss.IndexIVF):
+        base.make_direct_map()
+
+def search_parameters(params: Dict[str, Any], nprobe: Optional[int] = None,
+                      ef_search: Optional[int] = None, selector=None):
+    index_type = params.get('index_type', 'flat')
+
+    if index_type in ('ivf_flat', 'ivf_pq'):
+        return faiss.SearchParametersIVF(nprobe=nprobe or params['nprobe'], sel=selector)
+    if index_type == 'hnsw':
+        return faiss.SearchParametersHNSW(efSearch=ef_search or params['ef_search'], sel=selector)
+    if selector is not None:
+        return faiss.SearchParameters(sel=selector)
+    return None
+
+def bitmap_selector(bitmap: np.ndarray):
+    # bitmap is np.packbits(mask, bitorder='little') over index positions. The
+    # selector only points at it, so the caller keeps the array alive.
+    return faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap))
+
+def search(index: faiss.Index, id_map: Optional[np.ndarray], queries: np.ndarray, k: int,
+           search_params=None):
+    if search_params is None:
+        distances, labels = index.search(queries, k)
+        if id_map is None or isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+            return distances, labels
+        positions = labels
+    else:
+        # faiss 1.7.4's IndexIDMap rejects SearchParameters, so the underlying index
+        # is searched directly and its positional labels translated to image_ids.
+        # Selectors passed here therefore address positions, not image_ids.
+        distances, positions = inner_index(index).search(queries, k, params=search_params)
+        if id_map is None:
+            return distances, positions
+    labels = np.where(positions >= 0, id_map[np.maximum(positions, 0)], -1)
+    return distances, labels
+
+def read_index(path: str, mmap: bool = INDEX_MMAP) -> faiss.Index:
+    # With IO_FLAG_MMAP, IVF inverted lists stay in the file and are paged in on
+    # demand, so every uvicorn worker shares one page-cached copy. Flat and HNSW
+    # storage is still read into each process by faiss 1.7.4.
+    if mmap:
+        return faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    return faiss.read_index(path)
+
+def write_index(index: faiss.Index, path: str):
+    # Write-then-rename: workers may have the old file mapped, so it must never
+    # be truncated in place.
+    tmp_path = path + '.tmp'
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, path)
+
+def save_params(path: str, params: Dict[str, Any]):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(params, f, indent=2)
+
+def load_params(path: str) -> Dict[str, Any]:
+    if not os.path.exists(path):
+        return {'index_type': 'flat'}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
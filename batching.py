@@ -0,0 +1,150 @@
+import asyncio
+from typing import Any, Awaitable, Callable, List, Optional
+
+# Dynamic micro-batching for concurrent requests. Items submitted while a
+# batch is being collected (up to max_wait_ms after the first one, or until
+# max_batch_size) are handed to `process` together on the executor, and
+# each caller gets back its own entry of the returned list. `process` may
+# return an Exception instance for an item to fail only that caller.
+#
+# At most `concurrency` batches run at once; the next batch is only collected
+# when a slot frees up, so waiting items pile into bigger batches under load.
+# Beyond `max_queue` waiting items, submit() fails fast with Overloaded, and
+# a caller whose client disconnects is cancelled with Disconnected.
+
+class Overloaded(Exception):
+    pass
+
+class Disconnected(Exception):
+    pass
+
+class MicroBatcher:
+    def __init__(self, process: Callable[[List[Any]], List[Any]], max_batch_size: int = 16,
+                 max_wait_ms: float = 5.0, executor=None, concurrency: int = 1, max_queue: int = 0):
+        self.process = process
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.executor = executor
+        self.concurrency = max(1, concurrency)
+        self.max_queue = max_queue
+        self.queue: Optional[asyncio.Queue] = None
+        self.slots: Optional[asyncio.Semaphore] = None
+        self.task: Optional[asyncio.Task] = None
+        self.in_flight = set()
+        self.batches = 0
+        self.items = 0
+        self.rejected = 0
+        self.cancelled = 0
+
+    def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        self.slots = asyncio.Semaphore(self.concurrency)
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        # Batches already on the executor finish and answer their callers;
+        # callers still waiting in the queue are cancelled.
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        if self.in_flight:
+            await asyncio.gather(*self.in_flight, return_exceptions=True)
+        while self.queue is not None and not self.queue.empty():
+            _, future = self.queue.get_nowait()
+            future.cancel()
+
+    async def submit(self, item: Any, is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None,
+                     poll_interval: float = 0.1) -> Any:
+        if self.task is None:
+            self.start()
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((item, future))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise Overloaded(f"{self.queue.qsize()} requests already waiting")
+
+        if is_disconnected is None:
+            return await future
+
+        # A caller that disconnects is cancelled; if its batch has not started
+        # yet it is dropped without running the model.
+        while True:
+            done, _ = await asyncio.wait({future}, timeout=poll_interval)
+            if done:
+                return future.result()
+            if await is_disconnected():
+                future.cancel()
+                self.cancelled += 1
+                raise Disconnected()
+
+    async def _collect(self) -> List[tuple]:
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+
+        try:
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+        except asyncio.CancelledError:
+            # stop() while collecting: these items already left the queue.
+            for _, future in batch:
+                future.cancel()
+            raise
+
+        # Callers that gave up while waiting are dropped before any model work.
+        return [(item, future) for item, future in batch if not future.done()]
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.slots.acquire()
+            batch = await self._collect()
+            if not batch:
+                self.slots.release()
+                continue
+
+            task = loop.create_task(self._process(batch))
+            self.in_flight.add(task)
+            task.add_done_callback(self.in_flight.discard)
+
+    async def _process(self, batch: List[tuple]):
+        loop = asyncio.get_running_loop()
+        try:
+            try:
+                results = await loop.run_in_executor(self.executor, self.process, [item for item, _ in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+        finally:
+            self.slots.release()
+
+        self.batches += 1
+        self.items += len(batch)
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        return {
+            'batches': self.batches,
+            'items': self.items,
+            'mean_batch_size': round(self.items / self.batches, 2) if self.batches else 0.0,
+            'queued': self.queue.qsize() if self.queue is not None else 0,
+            'running': len(self.in_flight),
+            'rejected': self.rejected,
+            'cancelled': self.cancelled
+        }
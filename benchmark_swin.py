@@ -8,12 +8,16 @@ import os
 from pathlib import Path
 from tqdm import tqdm
 from sklearn.metrics import confusion_matrix, accuracy_score
-from config import MODEL_NAME, FAISS_INDEX_PATH, METADATA_PATH
+from config import MODEL_NAME
 import psycopg2
 from config import DATABASE_URL
 import requests
 from io import BytesIO
 import faiss
+from image_cache import default_cache
+from metadata_store import MetadataTable
+import snapshots
+from encoders import load_encoder
 from torchvision import transforms
 import torchvision.transforms.functional as TF
 
@@ -27,17 +31,33 @@ class SwinBenchmark:
         print(f"Device: {self.device}")
         
         self.feature_extractor = AutoFeatureExtractor.from_pretrained(MODEL_NAME)
-        self.model = AutoModel.from_pretrained(MODEL_NAME).to(self.device)
-        self.model.eval()
-        
-        print(f"Loading FAISS index from {FAISS_INDEX_PATH}")
-        self.index = faiss.read_index(FAISS_INDEX_PATH)
+        model = AutoModel.from_pretrained(MODEL_NAME).to(self.device)
+        model.eval()
+        self.encoder = load_encoder(MODEL_NAME, model, self.device)
+        print(f"Inference backend: {self.encoder.backend}")
+        
+        snapshot = snapshots.resolve()
+        print(f"Loading FAISS index from {snapshot.index_path}")
+        self.index = faiss.read_index(snapshot.index_path)
+        
+        if MetadataTable.exists(snapshot.metadata_dir):
+            print(f"Loading metadata from {snapshot.metadata_dir}")
+            self.metadata = MetadataTable.load(snapshot.metadata_dir)
+        else:
+            print(f"Loading legacy metadata from {snapshot.legacy_metadata_path}")
+            self.metadata = MetadataTable.from_legacy(snapshot.legacy_metadata_path)
         
-        print(f"Loading metadata from {METADATA_PATH}")
-        self.metadata = np.load(METADATA_PATH, allow_pickle=True)
+        if isinstance(self.index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+            self.position_ids = None
+        else:
+            legacy = np.load(snapshot.legacy_metadata_path, allow_pickle=True)
+            self.position_ids = np.array([int(meta['image_id']) for meta in legacy], dtype=np.int64)
         
         print(f"Total indexed images: {self.index.ntotal}")
         
+        self.session = requests.Session()
+        self.image_cache = default_cache()
+        
         self.heavy_augment = transforms.Compose([
             transforms.ColorJitter(brightness=0.3, contrast=0.3, saturation=0.2, hue=0.1),
             transforms.RandomRotation(degrees=15),
@@ -79,9 +99,13 @@ class SwinBenchmark:
     
     def download_image(self, url, timeout=10):
         try:
-            response = requests.get(url, timeout=timeout)
-            response.raise_for_status()
-            img = Image.open(BytesIO(response.content)).convert('RGB')
+            if self.image_cache is not None:
+                content = self.image_cache.fetch(url, session=self.session, timeout=timeout)
+            else:
+                response = self.session.get(url, timeout=timeout)
+                response.raise_for_status()
+                content = response.content
+            img = Image.open(BytesIO(content)).convert('RGB')
             return img
         except Exception as e:
             print(f"Error downloading {url}: {e}")
@@ -107,11 +131,8 @@ class SwinBenchmark:
     def extract_features_with_timing(self, image):
         start_time = time.time()
         
-        inputs = self.feature_extractor(images=image, return_tensors="pt").to(self.device)
-        
-        with torch.no_grad():
-            outputs = self.model(**inputs)
-            features = outputs.last_hidden_state[:, 0, :].cpu().numpy()
+        pixel_values = self.feature_extractor(images=image, return_tensors="pt")['pixel_values']
+        features = self.encoder(pixel_values)
         
         inference_time = (time.time() - start_time) * 1000
         
@@ -124,17 +145,21 @@ class SwinBenchmark:
         search_k = top_k + 10 if exclude_image_id else top_k
         distances, indices = self.index.search(query_vector, search_k)
         
+        labels = indices[0]
+        if self.position_ids is not None:
+            labels = np.where(labels >= 0, self.position_ids[np.maximum(labels, 0)], -1)
+        rows = self.metadata.rows(labels)
+        
         results = []
-        for idx, distance in zip(indices[0], distances[0]):
-            if idx < len(self.metadata):
-                meta = self.metadata[idx]
-                image_id = int(meta['image_id'])
+        for row, distance in zip(rows, distances[0]):
+            if row >= 0:
+                image_id = int(self.metadata.image_ids[row])
                 
                 if exclude_image_id and image_id == exclude_image_id:
                     continue
                 
                 results.append({
-                    'product_id': int(meta['product_id']),
+                    'product_id': int(self.metadata.product_ids[row]),
                     'image_id': image_id,
                     'distance': float(distance),
                     'similarity_score': float(1 / (1 + distance))
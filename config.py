@@ -6,7 +6,72 @@ load_dotenv()
 DATABASE_URL = os.getenv("DATABASE_URL")
 API_KEY = os.getenv("API_KEY")
 MODEL_NAME = os.getenv("MODEL_NAME", "microsoft/swin-tiny-patch4-window7-224")
+ENCODER_BACKEND = os.getenv("ENCODER_BACKEND", "torch")
+ONNX_DIR = os.getenv("ONNX_DIR", "./data/onnx")
+ENCODER_MIN_COSINE = float(os.getenv("ENCODER_MIN_COSINE", "0.99"))
 FAISS_INDEX_PATH = os.getenv("FAISS_INDEX_PATH", "./data/faiss_index.bin")
 METADATA_PATH = os.getenv("METADATA_PATH", "./data/metadata.npy")
+METADATA_DIR = os.getenv("METADATA_DIR", "./data/metadata")
+INDEX_STATE_PATH = os.getenv("INDEX_STATE_PATH", "./data/index_state.json")
+EMBEDDING_STORE_DIR = os.getenv("EMBEDDING_STORE_DIR", "./data/embeddings")
+INDEX_PARAMS_PATH = os.getenv("INDEX_PARAMS_PATH", "./data/index_params.json")
+INDEX_ROOT = os.getenv("INDEX_ROOT", "./data/index")
+INDEX_VERSION = os.getenv("INDEX_VERSION")
+INDEX_KEEP_VERSIONS = int(os.getenv("INDEX_KEEP_VERSIONS", "5"))
+INDEX_VERIFY_CHECKSUMS = os.getenv("INDEX_VERIFY_CHECKSUMS", "false").lower() in ("1", "true", "yes")
+PRODUCT_INDEX_PATH = os.getenv("PRODUCT_INDEX_PATH", "./data/product_index.bin")
+INDEX_MMAP = os.getenv("INDEX_MMAP", "true").lower() in ("1", "true", "yes")
+
+# FAISS index type: flat (exact), ivf_flat, ivf_pq or hnsw
+INDEX_TYPE = os.getenv("INDEX_TYPE", "flat").lower()
+INDEX_TRAIN_SAMPLE = int(os.getenv("INDEX_TRAIN_SAMPLE", "100000"))
+IVF_NLIST = int(os.getenv("IVF_NLIST", "0"))
+IVF_NPROBE = int(os.getenv("IVF_NPROBE", "16"))
+PQ_M = int(os.getenv("PQ_M", "64"))
+PQ_NBITS = int(os.getenv("PQ_NBITS", "8"))
+HNSW_M = int(os.getenv("HNSW_M", "32"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "200"))
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "64"))
+
+# Search mode: image (scan image vectors) or product (centroids, then re-rank images)
+SEARCH_MODE = os.getenv("SEARCH_MODE", "image").lower()
+PRODUCT_CANDIDATES = int(os.getenv("PRODUCT_CANDIDATES", "50"))
+
+# Concurrent /search requests are batched into one forward pass and one FAISS call
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "16"))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "5"))
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "1"))
+INFERENCE_QUEUE_SIZE = int(os.getenv("INFERENCE_QUEUE_SIZE", "64"))
+BATCH_SEARCH_CHUNK = int(os.getenv("BATCH_SEARCH_CHUNK", "32"))
+BATCH_SEARCH_MAX_IMAGES = int(os.getenv("BATCH_SEARCH_MAX_IMAGES", "1000"))
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(10 * 1024 * 1024)))
+MAX_BATCH_UPLOAD_BYTES = int(os.getenv("MAX_BATCH_UPLOAD_BYTES", str(256 * 1024 * 1024)))
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", "40000000"))
+URL_SEARCH_MAX_URLS = int(os.getenv("URL_SEARCH_MAX_URLS", "16"))
+URL_FETCH_TIMEOUT = float(os.getenv("URL_FETCH_TIMEOUT", "5"))
+URL_FETCH_MAX_BYTES = int(os.getenv("URL_FETCH_MAX_BYTES", str(10 * 1024 * 1024)))
+URL_FETCH_MAX_CONNECTIONS = int(os.getenv("URL_FETCH_MAX_CONNECTIONS", "32"))
+URL_FETCH_ALLOWED_HOSTS = [host.strip() for host in os.getenv("URL_FETCH_ALLOWED_HOSTS", "").split(",") if host.strip()]
+URL_FETCH_ALLOW_PRIVATE = os.getenv("URL_FETCH_ALLOW_PRIVATE", "false").lower() in ("1", "true", "yes")
+URL_FETCH_MAX_REDIRECTS = int(os.getenv("URL_FETCH_MAX_REDIRECTS", "3"))
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "1024"))
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", "300"))
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "4096"))
+FILTER_CATEGORY_CACHE_SIZE = int(os.getenv("FILTER_CATEGORY_CACHE_SIZE", "64"))
+
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "16"))
+DOWNLOAD_QUEUE_SIZE = int(os.getenv("DOWNLOAD_QUEUE_SIZE", "64"))
+DOWNLOAD_TIMEOUT = int(os.getenv("DOWNLOAD_TIMEOUT", "10"))
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", "3"))
+DOWNLOAD_BACKOFF = float(os.getenv("DOWNLOAD_BACKOFF", "0.5"))
+INDEX_BATCH_SIZE = int(os.getenv("INDEX_BATCH_SIZE", "32"))
+INDEX_WORKERS = int(os.getenv("INDEX_WORKERS", "1"))
+DB_FETCH_SIZE = int(os.getenv("DB_FETCH_SIZE", "2000"))
+INDEX_ADD_CHUNK = int(os.getenv("INDEX_ADD_CHUNK", "50000"))
+CHECKPOINT_EVERY = int(os.getenv("CHECKPOINT_EVERY", "500"))
+
+IMAGE_CACHE_ENABLED = os.getenv("IMAGE_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "./data/image_cache")
+IMAGE_CACHE_OFFLINE = os.getenv("IMAGE_CACHE_OFFLINE", "false").lower() in ("1", "true", "yes")
 
 print(f"[CONFIG] API_KEY loaded: '{API_KEY}'")
@@ -0,0 +1,261 @@
+import os
+import json
+import re
+import shutil
+import numpy as np
+from datetime import datetime, timezone
+from typing import List, Tuple
+
+# Append-only on-disk store of raw CLS embeddings, one directory per model.
+# Rows are committed by rewriting manifest.json after the data files are
+# flushed; anything past the manifest count is a torn write and is cut off.
+
+VECTORS_FILE = "vectors.f32"
+IDS_FILE = "image_ids.i64"
+PRODUCT_IDS_FILE = "product_ids.i64"
+URLS_FILE = "image_urls.txt"
+FAILURES_FILE = "failures.jsonl"
+MANIFEST_FILE = "manifest.json"
+
+class EmbeddingStore:
+    def __init__(self, root: str, model_name: str):
+        self.model_name = model_name
+        self.path = os.path.join(root, re.sub(r'[^A-Za-z0-9._-]+', '__', model_name))
+        self._finish_swap()
+        self.manifest = self._read_manifest()
+        self._recover()
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _read_manifest(self):
+        if not os.path.exists(self._file(MANIFEST_FILE)):
+            return {'model_name': self.model_name, 'dimension': None, 'dtype': 'float32', 'count': 0}
+
+        with open(self._file(MANIFEST_FILE), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+
+        if manifest['model_name'] != self.model_name:
+            raise ValueError(f"Store at {self.path} holds {manifest['model_name']}, not {self.model_name}")
+        return manifest
+
+    def _write_manifest(self):
+        self.manifest['updated_at'] = datetime.now(timezone.utc).isoformat()
+        tmp_path = self._file(MANIFEST_FILE + ".tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, self._file(MANIFEST_FILE))
+
+    def _recover(self):
+        count = self.manifest['count']
+        dimension = self.manifest['dimension'] or 0
+
+        for name, row_bytes in ((VECTORS_FILE, dimension * 4), (IDS_FILE, 8), (PRODUCT_IDS_FILE, 8)):
+            path = self._file(name)
+            if os.path.exists(path) and os.path.getsize(path) > count * row_bytes:
+                with open(path, 'r+b') as f:
+                    f.truncate(count * row_bytes)
+
+        urls_path = self._file(URLS_FILE)
+        if os.path.exists(urls_path):
+            urls = self._read_urls()
+            if len(urls) != count:
+                with open(urls_path, 'w', encoding='utf-8') as f:
+                    f.writelines(url + '\n' for url in urls[:count])
+
+    def _read_urls(self) -> List[str]:
+        if not os.path.exists(self._file(URLS_FILE)):
+            return []
+        with open(self._file(URLS_FILE), 'r', encoding='utf-8') as f:
+            return f.read().splitlines()
+
+    def __len__(self) -> int:
+        return self.manifest['count']
+
+    @property
+    def dimension(self):
+        return self.manifest['dimension']
+
+    def append(self, image_ids, product_ids, image_urls: List[str], vectors: np.ndarray):
+        if len(image_ids) == 0:
+            return
+
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if self.dimension is None:
+            self.manifest['dimension'] = int(vectors.shape[1])
+        elif vectors.shape[1] != self.dimension:
+            raise ValueError(f"Expected {self.dimension}-d vectors, got {vectors.shape[1]}-d")
+
+        os.makedirs(self.path, exist_ok=True)
+
+        columns = (
+            (VECTORS_FILE, vectors),
+            (IDS_FILE, np.asarray(image_ids, dtype=np.int64)),
+            (PRODUCT_IDS_FILE, np.asarray(product_ids, dtype=np.int64)),
+        )
+        for name, data in columns:
+            with open(self._file(name), 'ab') as f:
+                f.write(data.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+
+        with open(self._file(URLS_FILE), 'a', encoding='utf-8') as f:
+            f.writelines(url + '\n' for url in image_urls)
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.manifest['count'] += len(image_ids)
+        self._write_manifest()
+
+    def read(self, start: int = 0) -> Tuple[np.ndarray, np.ndarray, List[str], np.ndarray]:
+        count = len(self)
+        if count == 0 or start >= count:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, [], np.empty((0, self.dimension or 0), dtype=np.float32)
+
+        image_ids = np.fromfile(self._file(IDS_FILE), dtype=np.int64, count=count)[start:]
+        product_ids = np.fromfile(self._file(PRODUCT_IDS_FILE), dtype=np.int64, count=count)[start:]
+        image_urls = self._read_urls()[start:count]
+        vectors = np.memmap(self._file(VECTORS_FILE), dtype=np.float32, mode='r',
+                            shape=(count, self.dimension))[start:]
+
+        return image_ids, product_ids, image_urls, vectors
+
+    def drop(self, image_ids, chunk_size: int = 50000):
+        # Compacts the store without the given image_ids. Costs one sequential
+        # rewrite of the store; no model work. The kept rows are copied chunk
+        # by chunk into a sibling directory that is swapped in, so a crash
+        # leaves either the old or the new store, never an empty one.
+        drop_ids = np.asarray(image_ids, dtype=np.int64)
+        if len(self) == 0 or len(drop_ids) == 0:
+            return 0
+
+        all_ids, product_ids, image_urls, vectors = self.read()
+        keep = np.flatnonzero(~np.isin(all_ids, drop_ids))
+        dropped = int(len(all_ids) - len(keep))
+        if dropped == 0:
+            return 0
+
+        tmp_path = self.path + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        files = [open(os.path.join(tmp_path, name), 'wb') for name in (VECTORS_FILE, IDS_FILE, PRODUCT_IDS_FILE, URLS_FILE)]
+        try:
+            for start in range(0, len(keep), chunk_size):
+                rows = keep[start:start + chunk_size]
+                files[0].write(np.ascontiguousarray(vectors[rows]).tobytes())
+                files[1].write(all_ids[rows].tobytes())
+                files[2].write(product_ids[rows].tobytes())
+                files[3].write(''.join(image_urls[i] + '\n' for i in rows.tolist()).encode('utf-8'))
+            for f in files:
+                f.flush()
+                os.fsync(f.fileno())
+        finally:
+            for f in files:
+                f.close()
+        del vectors
+
+        # Build state and failures are kept; the manifest is written last and
+        # marks the new directory as complete.
+        if os.path.exists(self._file(FAILURES_FILE)):
+            shutil.copy2(self._file(FAILURES_FILE), os.path.join(tmp_path, FAILURES_FILE))
+        manifest = dict(self.manifest, count=len(keep), updated_at=datetime.now(timezone.utc).isoformat())
+        with open(os.path.join(tmp_path, MANIFEST_FILE), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+
+        old_path = self.path + '.old'
+        shutil.rmtree(old_path, ignore_errors=True)
+        os.replace(self.path, old_path)
+        os.replace(tmp_path, self.path)
+        shutil.rmtree(old_path, ignore_errors=True)
+        self.manifest = manifest
+        return dropped
+
+    def _finish_swap(self):
+        # A crash between drop()'s two renames leaves only the complete new
+        # directory (.tmp) and the old one (.old); anything else is a leftover.
+        tmp_path, old_path = self.path + '.tmp', self.path + '.old'
+        if not os.path.exists(self.path) and os.path.exists(old_path):
+            os.replace(tmp_path, self.path)
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        self.manifest = {'model_name': self.model_name, 'dimension': None, 'dtype': 'float32', 'count': 0}
+
+    def begin_build(self, watermark: int, min_id: int = 0):
+        os.makedirs(self.path, exist_ok=True)
+        self.manifest['build'] = {
+            'status': 'running',
+            'min_id': int(min_id),
+            'watermark': int(watermark),
+            'started_at': datetime.now(timezone.utc).isoformat()
+        }
+        self._write_manifest()
+
+    def finish_build(self, status: str = 'complete'):
+        # 'embedded' marks a shard whose vectors are all in, waiting to be merged.
+        if 'build' in self.manifest:
+            self.manifest['build']['status'] = status
+            self._write_manifest()
+
+    @property
+    def build_status(self):
+        return self.manifest.get('build', {}).get('status')
+
+    def add_failures(self, rows, reason: str):
+        if not rows:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        with open(self._file(FAILURES_FILE), 'a', encoding='utf-8') as f:
+            for image_id, image_url, product_id in rows:
+                f.write(json.dumps({
+                    'image_id': int(image_id),
+                    'image_url': image_url,
+                    'product_id': int(product_id),
+                    'reason': reason
+                }) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def failures(self) -> List[dict]:
+        # Latest failure per image_id; a torn last line from a crash is skipped.
+        if not os.path.exists(self._file(FAILURES_FILE)):
+            return []
+
+        latest = {}
+        with open(self._file(FAILURES_FILE), 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    failure = json.loads(line)
+                except ValueError:
+                    continue
+                latest[failure['image_id']] = failure
+        return list(latest.values())
+
+    def forget_failures(self, image_ids):
+        # Rewrites the log without the given (since embedded) image_ids;
+        # swapped in whole, so a crash keeps the previous log.
+        if not os.path.exists(self._file(FAILURES_FILE)):
+            return
+        forget = set(np.asarray(image_ids, dtype=np.int64).tolist())
+        remaining = [failure for failure in self.failures() if failure['image_id'] not in forget]
+
+        tmp_path = self._file(FAILURES_FILE + ".tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.writelines(json.dumps(failure) + '\n' for failure in remaining)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._file(FAILURES_FILE))
+
+def latest_positions(image_ids: np.ndarray) -> np.ndarray:
+    # Row positions of the newest entry for every image_id, in store order.
+    if len(image_ids) == 0:
+        return np.empty(0, dtype=np.int64)
+    _, reversed_first = np.unique(image_ids[::-1], return_index=True)
+    return np.sort(len(image_ids) - 1 - reversed_first)
@@ -0,0 +1,184 @@
+import os
+import time
+import numpy as np
+import torch
+from typing import Dict, Tuple
+from config import ENCODER_BACKEND, ONNX_DIR, ENCODER_MIN_COSINE
+
+# Inference backends for the Swin encoder. Every encoder takes the normalised
+# pixel batch from ImagePreprocessor and returns the (n, d) float32 CLS
+# embeddings the index is built from:
+#   torch - the eager fp32 model
+#   int8  - the same model with Linear layers dynamically quantized to int8
+#   onnx  - the encoder exported once to ONNX_DIR and run with ONNX Runtime
+# Optimized backends are checked against fp32 when loaded and refuse to serve
+# below ENCODER_MIN_COSINE; main() compares them on real images.
+
+ENCODER_BACKENDS = ('torch', 'int8', 'onnx')
+
+class TorchEncoder:
+    def __init__(self, model, device, backend: str = 'torch'):
+        self.model = model
+        self.device = device
+        self.backend = backend
+        self.hidden_size = model.config.hidden_size
+
+    def __call__(self, pixel_values: torch.Tensor) -> np.ndarray:
+        with torch.no_grad():
+            outputs = self.model(pixel_values=pixel_values.to(self.device))
+            features = outputs.last_hidden_state[:, 0, :].cpu().numpy()
+        return np.ascontiguousarray(features, dtype=np.float32)
+
+def _onnxruntime():
+    try:
+        import onnxruntime
+    except ImportError:
+        raise RuntimeError("ENCODER_BACKEND=onnx needs the onnx and onnxruntime packages")
+    return onnxruntime
+
+class OnnxEncoder:
+    def __init__(self, path: str, hidden_size: int):
+        onnxruntime = _onnxruntime()
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = torch.get_num_threads()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.backend = 'onnx'
+        self.hidden_size = hidden_size
+
+    def __call__(self, pixel_values: torch.Tensor) -> np.ndarray:
+        features = self.session.run(None, {'pixel_values': pixel_values.cpu().numpy()})[0]
+        return np.ascontiguousarray(features, dtype=np.float32)
+
+class _ClsOutput(torch.nn.Module):
+    # Exports only the CLS embedding, not the full hidden-state tensor.
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return self.model(pixel_values=pixel_values).last_hidden_state[:, 0, :]
+
+def onnx_path(model_name: str) -> str:
+    return os.path.join(ONNX_DIR, model_name.replace('/', '__') + '.onnx')
+
+def export_onnx(model, path: str, input_size: Tuple[int, int] = (224, 224)):
+    print(f"Exporting ONNX encoder to {path}...")
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    dummy = torch.zeros(1, 3, input_size[1], input_size[0])
+    tmp_path = path + '.tmp'
+    torch.onnx.export(
+        _ClsOutput(model.cpu()).eval(), (dummy,), tmp_path,
+        input_names=['pixel_values'], output_names=['embedding'],
+        dynamic_axes={'pixel_values': {0: 'batch'}, 'embedding': {0: 'batch'}},
+        opset_version=17
+    )
+    os.replace(tmp_path, path)
+
+def quantize_int8(model):
+    return torch.quantization.quantize_dynamic(model.cpu(), {torch.nn.Linear}, dtype=torch.qint8)
+
+def cosine_similarity(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    a = a / np.maximum(np.linalg.norm(a, axis=1, keepdims=True), 1e-12)
+    b = b / np.maximum(np.linalg.norm(b, axis=1, keepdims=True), 1e-12)
+    return (a * b).sum(axis=1)
+
+def check_encoder(reference: TorchEncoder, encoder, input_size: Tuple[int, int],
+                  min_cosine: float = ENCODER_MIN_COSINE):
+    # Smoke check on a fixed random batch: catches a broken export or
+    # quantization before it serves. Retrieval quality is checked by main().
+    generator = torch.Generator().manual_seed(0)
+    pixel_values = torch.randn(4, 3, input_size[1], input_size[0], generator=generator)
+    worst = float(cosine_similarity(reference(pixel_values), encoder(pixel_values)).min())
+    if worst < min_cosine:
+        raise ValueError(f"{encoder.backend} encoder deviates from fp32: cosine {worst:.4f} < {min_cosine}")
+
+def load_encoder(model_name: str, model, device, input_size: Tuple[int, int] = (224, 224),
+                 backend: str = ENCODER_BACKEND):
+    if backend not in ENCODER_BACKENDS:
+        raise ValueError(f"Unknown ENCODER_BACKEND '{backend}', expected one of {', '.join(ENCODER_BACKENDS)}")
+
+    reference = TorchEncoder(model, device)
+    if backend == 'torch':
+        return reference
+    if device.type != 'cpu':
+        raise ValueError(f"ENCODER_BACKEND={backend} only runs on CPU")
+
+    if backend == 'int8':
+        encoder = TorchEncoder(quantize_int8(model), device, backend='int8')
+    else:
+        _onnxruntime()
+        path = onnx_path(model_name)
+        if not os.path.exists(path):
+            export_onnx(model, path, input_size)
+        encoder = OnnxEncoder(path, reference.hidden_size)
+
+    check_encoder(reference, encoder, input_size)
+    return encoder
+
+def compare_encoders(reference, encoder, pixel_values: torch.Tensor, k: int = 10,
+                     batch_size: int = 32) -> Dict[str, float]:
+    # Embedding agreement and retrieval agreement: the images are the gallery,
+    # each one is queried with both encoders and the top-k neighbours compared.
+    import faiss
+
+    def embed(model):
+        start = time.time()
+        vectors = np.concatenate([model(pixel_values[i:i + batch_size]) for i in range(0, len(pixel_values), batch_size)])
+        return vectors, (time.time() - start) * 1000 / len(pixel_values)
+
+    expected, reference_ms = embed(reference)
+    actual, encoder_ms = embed(encoder)
+    cosines = cosine_similarity(expected, actual)
+
+    k = min(k, len(expected))
+    gallery = faiss.IndexFlatL2(expected.shape[1])
+    gallery.add(expected)
+    _, expected_ids = gallery.search(expected, k)
+    _, actual_ids = gallery.search(actual, k)
+    recall = np.mean([len(set(e) & set(a)) / k for e, a in zip(expected_ids.tolist(), actual_ids.tolist())])
+
+    return {
+        'min_cosine': float(cosines.min()),
+        'mean_cosine': float(cosines.mean()),
+        f'recall@{k}': float(recall),
+        'reference_ms': reference_ms,
+        'encoder_ms': encoder_ms
+    }
+
+def main():
+    import argparse
+    from transformers import AutoFeatureExtractor, AutoModel
+    from config import MODEL_NAME
+    from preprocessing import ImagePreprocessor
+
+    parser = argparse.ArgumentParser(description='Compare an optimized encoder backend with the fp32 model')
+    parser.add_argument('images', nargs='+', help='Image files used as queries and gallery')
+    parser.add_argument('--backend', choices=ENCODER_BACKENDS[1:], default='int8')
+    parser.add_argument('--k', type=int, default=10, help='Neighbours compared for recall')
+    parser.add_argument('--min-cosine', type=float, default=ENCODER_MIN_COSINE)
+    parser.add_argument('--min-recall', type=float, default=0.95)
+    args = parser.parse_args()
+
+    device = torch.device('cpu')
+    preprocessor = ImagePreprocessor(AutoFeatureExtractor.from_pretrained(MODEL_NAME))
+    model = AutoModel.from_pretrained(MODEL_NAME).eval()
+    reference = TorchEncoder(model, device)
+    encoder = load_encoder(MODEL_NAME, model, device, preprocessor.input_size, backend=args.backend)
+
+    images = []
+    for path in args.images:
+        with open(path, 'rb') as f:
+            images.append(preprocessor.decode(f.read()))
+    stats = compare_encoders(reference, encoder, preprocessor(images), k=args.k)
+
+    recall_key = next(key for key in stats if key.startswith('recall@'))
+    print(f"cosine min {stats['min_cosine']:.4f}, mean {stats['mean_cosine']:.4f}; {recall_key} {stats[recall_key]:.3f}")
+    print(f"fp32 {stats['reference_ms']:.1f} ms/image, {args.backend} {stats['encoder_ms']:.1f} ms/image "
+          f"({stats['reference_ms'] / max(stats['encoder_ms'], 1e-6):.2f}x)")
+
+    ok = stats['min_cosine'] >= args.min_cosine and stats[recall_key] >= args.min_recall
+    print("OK" if ok else "FAILED: embeddings or recall below tolerance")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import os
+import json
+import hashlib
+import tempfile
+import requests
+from datetime import datetime, timezone
+from config import IMAGE_CACHE_ENABLED, IMAGE_CACHE_DIR, IMAGE_CACHE_OFFLINE
+
+# On-disk cache of product image bytes shared by indexing and the benchmark.
+# Bytes are stored once per content hash under blobs/; entries/ maps each URL
+# to its blob plus the ETag / Last-Modified needed for a conditional GET.
+
+class ImageCache:
+    def __init__(self, root: str = IMAGE_CACHE_DIR, offline: bool = IMAGE_CACHE_OFFLINE):
+        self.root = root
+        self.offline = offline
+
+    def _entry_path(self, url: str) -> str:
+        return os.path.join(self.root, 'entries', hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self.root, 'blobs', digest[:2], digest)
+
+    def _write_atomic(self, path: str, data: bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _read_entry(self, url: str):
+        try:
+            with open(self._entry_path(url), 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if entry.get('url') != url or not os.path.exists(self._blob_path(entry['blob'])):
+            return None
+        return entry
+
+    def _read_blob(self, entry) -> bytes:
+        with open(self._blob_path(entry['blob']), 'rb') as f:
+            return f.read()
+
+    def _store(self, url: str, response: requests.Response) -> bytes:
+        content = response.content
+        digest = hashlib.sha256(content).hexdigest()
+        if not os.path.exists(self._blob_path(digest)):
+            self._write_atomic(self._blob_path(digest), content)
+
+        entry = {
+            'url': url,
+            'blob': digest,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'fetched_at': datetime.now(timezone.utc).isoformat()
+        }
+        self._write_atomic(self._entry_path(url), json.dumps(entry).encode('utf-8'))
+        return content
+
+    def fetch(self, url: str, session: requests.Session = None, timeout: int = 10) -> bytes:
+        entry = self._read_entry(url)
+
+        if self.offline:
+            if entry is None:
+                raise FileNotFoundError(f"{url} is not cached (offline mode)")
+            return self._read_blob(entry)
+
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        response = (session or requests).get(url, headers=headers, timeout=timeout)
+        if response.status_code == 304 and entry is not None:
+            return self._read_blob(entry)
+
+        response.raise_for_status()
+        return self._store(url, response)
+
+def default_cache():
+    return ImageCache() if IMAGE_CACHE_ENABLED else None
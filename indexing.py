@@ -4,111 +4,734 @@ import faiss
 import torch
 from PIL import Image
 import requests
-from io import BytesIO
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from transformers import AutoFeatureExtractor, AutoModel
 from tqdm import tqdm
 import os
-from config import DATABASE_URL, MODEL_NAME, FAISS_INDEX_PATH, METADATA_PATH
+import queue
+import shutil
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import List, Dict, Any, Tuple
+from config import (
+    DATABASE_URL, MODEL_NAME, ENCODER_BACKEND,
+    DOWNLOAD_WORKERS, DOWNLOAD_QUEUE_SIZE, DOWNLOAD_TIMEOUT, DOWNLOAD_RETRIES, DOWNLOAD_BACKOFF,
+    INDEX_BATCH_SIZE, EMBEDDING_STORE_DIR, INDEX_WORKERS,
+    DB_FETCH_SIZE, INDEX_ADD_CHUNK, CHECKPOINT_EVERY, INDEX_TRAIN_SAMPLE
+)
+from embedding_store import EmbeddingStore, latest_positions
+from metadata_store import MetadataTable
+import snapshots
+from image_cache import default_cache
+from preprocessing import ImagePreprocessor, decode_image
+from encoders import load_encoder
+from ann_index import (
+    index_params_from_config, create_index, needs_training, train_index, save_params, load_params,
+    write_index, product_centroid_index, inner_index
+)
 
-def download_image(url: str, timeout: int = 10) -> Image.Image:
+_DONE = object()
+
+def create_session(pool_size: int = DOWNLOAD_WORKERS, retries: int = DOWNLOAD_RETRIES,
+                   backoff: float = DOWNLOAD_BACKOFF) -> requests.Session:
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(['GET'])
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+image_cache = default_cache()
+
+def fetch_image_bytes(url: str, timeout: int = DOWNLOAD_TIMEOUT, session: requests.Session = None) -> bytes:
+    if image_cache is not None:
+        return image_cache.fetch(url, session=session, timeout=timeout)
+    
+    response = (session or requests).get(url, timeout=timeout)
+    response.raise_for_status()
+    return response.content
+
+def download_image(url: str, timeout: int = DOWNLOAD_TIMEOUT, session: requests.Session = None,
+                   size: Tuple[int, int] = (224, 224)) -> Image.Image:
     try:
-        response = requests.get(url, timeout=timeout)
-        response.raise_for_status()
-        img = Image.open(BytesIO(response.content)).convert('RGB')
-        return img
+        content = fetch_image_bytes(url, timeout=timeout, session=session)
+        return decode_image(content, size)
     except Exception as e:
         print(f"Error downloading {url}: {e}")
         return None
 
-def extract_features(image: Image.Image, feature_extractor, model, device) -> np.ndarray:
-    inputs = feature_extractor(images=image, return_tensors="pt").to(device)
+def extract_features_batch(images: List[Image.Image], preprocessor: ImagePreprocessor, model, device) -> np.ndarray:
+    # `model` is an encoder from encoders.load_encoder (ENCODER_BACKEND).
+    return model(preprocessor(images))
+
+def extract_features(image: Image.Image, preprocessor, model, device) -> np.ndarray:
+    return extract_features_batch([image], preprocessor, model, device)[0]
+
+def embed_batch(batch, preprocessor, model, device):
+    # One forward pass per batch; if it fails, fall back to single images so one
+    # corrupt file only costs its own row instead of the whole batch.
+    rows = [row for row, _ in batch]
+    try:
+        return rows, extract_features_batch([img for _, img in batch], preprocessor, model, device), []
+    except Exception as e:
+        print(f"\nBatch of {len(batch)} failed ({e}), retrying images one by one")
+    
+    ok_rows = []
+    failed_rows = []
+    vectors = []
+    for row, img in batch:
+        try:
+            vectors.append(extract_features(img, preprocessor, model, device))
+            ok_rows.append(row)
+        except Exception as e:
+            print(f"\nError processing image {row[0]}: {e}")
+            failed_rows.append(row)
+    
+    return ok_rows, np.array(vectors, dtype=np.float32), failed_rows
+
+def download_images(rows, session: requests.Session, workers: int = DOWNLOAD_WORKERS,
+                    queue_size: int = DOWNLOAD_QUEUE_SIZE, size: Tuple[int, int] = (224, 224)):
+    # Downloads run on a thread pool while the caller embeds; at most queue_size
+    # images are in flight or waiting, so a slow model never buffers the catalog.
+    results = queue.Queue()
+    slots = threading.Semaphore(queue_size)
+    stop = threading.Event()
     
-    with torch.no_grad():
-        outputs = model(**inputs)
-        features = outputs.last_hidden_state[:, 0, :].cpu().numpy()
+    def fetch(row):
+        try:
+            results.put((row, download_image(row[1], session=session, size=size)))
+        except Exception:
+            results.put((row, None))
+    
+    def feed():
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for row in rows:
+                while not slots.acquire(timeout=0.5):
+                    if stop.is_set():
+                        break
+                if stop.is_set():
+                    break
+                executor.submit(fetch, row)
+        results.put(_DONE)
     
-    return features.flatten()
+    feeder = threading.Thread(target=feed, name="image-downloader", daemon=True)
+    feeder.start()
+    
+    try:
+        while True:
+            item = results.get()
+            if item is _DONE:
+                break
+            slots.release()
+            yield item
+    finally:
+        stop.set()
+
+MAX_IMAGE_ID = 2 ** 63 - 1
+
+ACTIVE_IMAGES_FROM = """
+    FROM product_images pi
+    INNER JOIN product_variants pv ON pi.variant_id = pv.id
+    INNER JOIN products p ON pv.product_id = p.id
+    WHERE pv.deleted_at IS NULL 
+      AND p.status = 'active'
+      AND p.deleted_at IS NULL
+      AND pi.id BETWEEN %(min_id)s AND %(max_id)s
+"""
+
+ACTIVE_IMAGES_QUERY = """
+    SELECT 
+        pi.id as image_id,
+        pi.image_url,
+        pv.product_id
+""" + ACTIVE_IMAGES_FROM + """
+    ORDER BY pi.id
+"""
+
+COUNT_IMAGES_QUERY = "SELECT COUNT(*), COALESCE(MAX(pi.id), 0)" + ACTIVE_IMAGES_FROM
 
-def build_index():
+ATTRIBUTES_QUERY = """
+    SELECT
+        pi.id as image_id,
+        p.category_id,
+        p.selling_price,
+        COALESCE(pv.total_stock, 0) - COALESCE(pv.reserved_stock, 0) as stock
+""" + ACTIVE_IMAGES_FROM + """
+    ORDER BY pi.id
+"""
+
+SHARD_RANGES_QUERY = """
+    SELECT MIN(image_id), MAX(image_id), COUNT(*)
+    FROM (
+        SELECT pi.id as image_id, ntile(%(shards)s) OVER (ORDER BY pi.id) as shard
+""" + ACTIVE_IMAGES_FROM + """
+    ) ranked
+    GROUP BY shard
+    ORDER BY shard
+"""
+
+def load_model():
     print("Loading model...")
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    feature_extractor = AutoFeatureExtractor.from_pretrained(MODEL_NAME)
+    preprocessor = ImagePreprocessor(AutoFeatureExtractor.from_pretrained(MODEL_NAME))
     model = AutoModel.from_pretrained(MODEL_NAME).to(device)
     model.eval()
-    
+    encoder = load_encoder(MODEL_NAME, model, device, preprocessor.input_size)
+    print(f"Inference backend: {encoder.backend}")
+    return preprocessor, encoder, device
+
+def connect():
     print(f"Connecting to database: {DATABASE_URL.split('@')[1] if '@' in DATABASE_URL else 'hidden'}")
-    conn = psycopg2.connect(DATABASE_URL)
-    cursor = conn.cursor()
-    
-    query = """
-        SELECT 
-            pi.id as image_id,
-            pi.image_url,
-            pv.product_id
-        FROM product_images pi
-        INNER JOIN product_variants pv ON pi.variant_id = pv.id
-        INNER JOIN products p ON pv.product_id = p.id
-        WHERE pv.deleted_at IS NULL 
-          AND p.status = 'active'
-          AND p.deleted_at IS NULL
-        ORDER BY pi.id
-    """
-    
-    print("Fetching images from database...")
-    cursor.execute(query)
-    images = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    
-    print(f"Found {len(images)} images to index")
+    return psycopg2.connect(DATABASE_URL)
+
+def count_images(min_id: int = 0, max_id: int = MAX_IMAGE_ID):
+    conn = connect()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(COUNT_IMAGES_QUERY, {'min_id': min_id, 'max_id': max_id})
+            count, last_id = cursor.fetchone()
+    finally:
+        conn.close()
     
-    vectors = []
-    metadata = []
+    return int(count), int(last_id)
+
+def iter_images(min_id: int = 0, max_id: int = MAX_IMAGE_ID, fetch_size: int = DB_FETCH_SIZE):
+    # Named (server-side) cursor: rows are pulled fetch_size at a time instead of
+    # materialising the whole join in client memory.
+    conn = connect()
+    try:
+        with conn.cursor(name='image_search_index') as cursor:
+            cursor.itersize = fetch_size
+            cursor.execute(ACTIVE_IMAGES_QUERY, {'min_id': min_id, 'max_id': max_id})
+            for row in cursor:
+                yield row
+    finally:
+        conn.close()
+
+def shard_ranges(shards: int):
+    conn = connect()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(SHARD_RANGES_QUERY, {'shards': shards, 'min_id': 0, 'max_id': MAX_IMAGE_ID})
+            return [(int(lo), int(hi), int(count)) for lo, hi, count in cursor.fetchall()]
+    finally:
+        conn.close()
+
+def fetch_attributes(fetch_size: int = DB_FETCH_SIZE) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+    # Filter columns (category, price, available stock) for every active image.
+    image_ids, category_ids, prices, stocks = [], [], [], []
+    conn = connect()
+    try:
+        with conn.cursor(name='image_search_attributes') as cursor:
+            cursor.itersize = fetch_size
+            cursor.execute(ATTRIBUTES_QUERY, {'min_id': 0, 'max_id': MAX_IMAGE_ID})
+            for image_id, category_id, price, stock in cursor:
+                image_ids.append(image_id)
+                category_ids.append(-1 if category_id is None else category_id)
+                prices.append(np.nan if price is None else float(price))
+                stocks.append(stock)
+    finally:
+        conn.close()
+    
+    return np.array(image_ids, dtype=np.int64), {
+        'category_id': np.array(category_ids, dtype=np.int64),
+        'price': np.array(prices, dtype=np.float64),
+        'stock': np.array(stocks, dtype=np.int64)
+    }
+
+def attach_attributes(metadata: MetadataTable) -> MetadataTable:
+    try:
+        image_ids, columns = fetch_attributes()
+    except psycopg2.Error as e:
+        print(f"Could not load filter attributes ({e}); filtered search will be unavailable")
+        return metadata
+    print(f"Loaded filter attributes for {len(image_ids)} images")
+    return metadata.with_attributes(image_ids, columns)
+
+def refresh_attributes():
+    # Stock and prices change far more often than images: publish a version
+    # that shares the index files with the current one and only has new
+    # metadata, then POST /reload.
+    current = snapshots.resolve()
+    if not MetadataTable.exists(current.metadata_dir):
+        print(f"No metadata at {current.metadata_dir}, run a build first")
+        return
+    image_ids, columns = fetch_attributes()
+    metadata = MetadataTable.load(current.metadata_dir, mmap=False).with_attributes(image_ids, columns)
+    
+    if current.version is None:
+        metadata.save(current.metadata_dir)
+    else:
+        snapshot = snapshots.create()
+        known = snapshot.link_from(current, [
+            os.path.basename(current.index_path),
+            os.path.basename(current.product_index_path),
+            os.path.basename(current.params_path)
+        ])
+        metadata.save(snapshot.metadata_dir)
+        manifest = {k: v for k, v in current.manifest.items() if k not in ('version', 'built_at', 'checksums')}
+        manifest['parent_version'] = current.version
+        published = snapshots.publish(snapshot, manifest, known)
+        print(f"Published index version {published.version}")
+    print(f"Refreshed filter attributes for {len(metadata)} indexed images")
+
+def open_store() -> EmbeddingStore:
+    return EmbeddingStore(EMBEDDING_STORE_DIR, MODEL_NAME)
+
+def embed_images(images, preprocessor, model, device, store: EmbeddingStore,
+                 batch_size: int = INDEX_BATCH_SIZE, desc: str = "Extracting features",
+                 total: int = None, checkpoint_every: int = CHECKPOINT_EVERY) -> int:
+    processed_count = 0
     failed_count = 0
     
-    for image_id, image_url, product_id in tqdm(images, desc="Extracting features"):
-        img = download_image(image_url)
+    session = create_session()
+    downloads = download_images(images, session, size=preprocessor.input_size)
+    
+    batch = []
+    pending_rows = []
+    pending_vectors = []
+    failed_downloads = []
+    failed_embeddings = []
+    
+    def flush():
+        nonlocal processed_count, failed_count
+        rows, batch_vectors, failed_rows = embed_batch(batch, preprocessor, model, device)
+        failed_count += len(failed_rows)
+        failed_embeddings.extend(failed_rows)
+        processed_count += len(rows)
+        pending_rows.extend(rows)
+        if len(rows) > 0:
+            pending_vectors.append(batch_vectors)
+        batch.clear()
+    
+    def checkpoint():
+        # Everything before a checkpoint survives a crash: --resume skips the
+        # committed image_ids and --retry-failed picks up the failure log.
+        if pending_rows:
+            store.append(
+                [image_id for image_id, _, _ in pending_rows],
+                [product_id for _, _, product_id in pending_rows],
+                [image_url for _, image_url, _ in pending_rows],
+                np.concatenate(pending_vectors)
+            )
+        store.add_failures(failed_downloads, 'download')
+        store.add_failures(failed_embeddings, 'embedding')
+        for pending in (pending_rows, pending_vectors, failed_downloads, failed_embeddings):
+            pending.clear()
+    
+    for row, img in tqdm(downloads, total=total if total is not None else len(images), desc=desc):
         if img is None:
             failed_count += 1
+            failed_downloads.append(row)
             continue
         
-        try:
-            vector = extract_features(img, feature_extractor, model, device)
-            vectors.append(vector)
-            metadata.append({
-                'image_id': int(image_id),
-                'product_id': int(product_id),
-                'image_url': image_url
-            })
-        except Exception as e:
-            print(f"\nError processing image {image_id}: {e}")
-            failed_count += 1
-            continue
+        batch.append((row, img))
+        if len(batch) >= batch_size:
+            flush()
+        if len(pending_rows) + len(failed_downloads) >= checkpoint_every:
+            checkpoint()
+    
+    if batch:
+        flush()
+    checkpoint()
     
-    print(f"\nSuccessfully processed {len(vectors)} images")
+    session.close()
+    
+    print(f"\nSuccessfully processed {processed_count} images")
     print(f"Failed: {failed_count} images")
     
-    if len(vectors) == 0:
+    return processed_count
+
+def load_state() -> Dict[str, Any]:
+    # Manifest of the live index version (model_name, watermark, ...).
+    return snapshots.resolve().manifest
+
+def save_product_index(store: EmbeddingStore, metadata: MetadataTable, path: str):
+    # First stage of product search: one centroid per indexed product.
+    image_ids, _, _, vectors = store.read()
+    positions = latest_positions(image_ids)
+    rows = metadata.rows(image_ids[positions])
+    positions, rows = positions[rows >= 0], rows[rows >= 0]
+    if len(positions) == 0:
+        return
+    
+    product_index = product_centroid_index(vectors, positions, metadata.product_ids[rows], INDEX_ADD_CHUNK)
+    print(f"Saving {product_index.ntotal} product centroids...")
+    write_index(product_index, path)
+
+def save_index(index, metadata: MetadataTable, watermark: int, params: Dict[str, Any],
+               store: EmbeddingStore):
+    # Every build is written as a new version directory and only becomes
+    # live once complete; older versions stay available for rollback.
+    snapshot = snapshots.create()
+    
+    print(f"Saving {params['index_type']} index to {snapshot.path}...")
+    write_index(index, snapshot.index_path)
+    save_params(snapshot.params_path, params)
+    save_product_index(store, metadata, snapshot.product_index_path)
+    
+    metadata = attach_attributes(metadata)
+    print("Saving metadata...")
+    metadata.save(snapshot.metadata_dir)
+    
+    published = snapshots.publish(snapshot, {
+        'model_name': MODEL_NAME,
+        'encoder_backend': ENCODER_BACKEND,
+        'dimension': int(index.d),
+        'count': int(index.ntotal),
+        'index_type': params['index_type'],
+        'watermark': int(watermark)
+    })
+    print(f"Published index version {published.version}")
+
+def resumable_store(store: EmbeddingStore, resume: bool) -> set:
+    # Returns the image_ids already committed by an interrupted build, or starts
+    # the store over.
+    if resume and store.build_status in ('running', 'embedded'):
+        done = set(store.read()[0].tolist())
+        print(f"Resuming interrupted build: {len(done)} images already embedded, "
+              f"{len(store.failures())} failures recorded")
+        return done
+    
+    if resume:
+        print("No interrupted build to resume, starting a full build")
+    store.clear()
+    return set()
+
+def build_index(batch_size: int = INDEX_BATCH_SIZE, resume: bool = False):
+    preprocessor, model, device = load_model()
+    
+    total, watermark = count_images()
+    print(f"Found {total} images to index")
+    
+    store = open_store()
+    done = resumable_store(store, resume)
+    store.begin_build(watermark)
+    
+    images = (row for row in iter_images() if row[0] not in done)
+    embed_images(images, preprocessor, model, device, store, batch_size,
+                 total=max(total - len(done), 0))
+    
+    build_index_from_store(store, watermark)
+    store.finish_build()
+
+def shard_store(shard_no: int) -> EmbeddingStore:
+    return EmbeddingStore(os.path.join(EMBEDDING_STORE_DIR, 'shards', f'shard_{shard_no}'), MODEL_NAME)
+
+def embed_shard(shard_no: int, min_id: int, max_id: int, total: int, threads: int,
+                cores: List[int], batch_size: int, resume: bool = False) -> int:
+    # Runs in a spawned worker: pin it to its own cores and intra-op threads so
+    # shards do not oversubscribe the CPU.
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+    
+    store = shard_store(shard_no)
+    build = store.manifest.get('build', {})
+    if resume and store.build_status == 'embedded' and (build.get('min_id'), build.get('watermark')) == (min_id, max_id):
+        print(f"Shard {shard_no} was already embedded, skipping")
+        return 0
+    
+    preprocessor, model, device = load_model()
+    done = resumable_store(store, resume)
+    store.begin_build(max_id, min_id)
+    
+    images = (row for row in iter_images(min_id, max_id) if row[0] not in done)
+    processed_count = embed_images(images, preprocessor, model, device, store, batch_size,
+                                   desc=f"Shard {shard_no}", total=max(total - len(done), 0))
+    # Not 'complete': the shard is kept, and skipped by --resume, until the
+    # merged index is published.
+    store.finish_build('embedded')
+    return processed_count
+
+def merge_shards(shard_count: int, watermark: int, chunk_size: int = 10000) -> EmbeddingStore:
+    # The merged store stays 'running' until its index is published, so an
+    # interrupted merge is never served by --from-store, --delta or --retry-failed.
+    store = open_store()
+    store.clear()
+    store.begin_build(watermark)
+    
+    for shard_no in range(shard_count):
+        shard = shard_store(shard_no)
+        image_ids, product_ids, image_urls, vectors = shard.read()
+        print(f"Merging shard {shard_no}: {len(image_ids)} vectors")
+        
+        for start in range(0, len(image_ids), chunk_size):
+            end = start + chunk_size
+            store.append(image_ids[start:end], product_ids[start:end], image_urls[start:end],
+                         vectors[start:end])
+        
+        for failure in shard.failures():
+            store.add_failures([(failure['image_id'], failure['image_url'], failure['product_id'])],
+                               failure['reason'])
+        del vectors
+    
+    return store
+
+def build_index_sharded(workers: int = INDEX_WORKERS, batch_size: int = INDEX_BATCH_SIZE,
+                        resume: bool = False):
+    total, watermark = count_images()
+    print(f"Found {total} images to index")
+    
+    if hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    workers = max(1, min(workers, total, len(cores)))
+    threads = max(1, len(cores) // workers)
+    
+    # ntile over image_id gives equal-count, contiguous id ranges; each worker
+    # streams only its own range from the database.
+    shards = shard_ranges(workers)
+    if not shards:
+        print("No vectors to index!")
+        return
+    workers = len(shards)
+    
+    for shard_no, (min_id, max_id, count) in enumerate(shards):
+        print(f"Shard {shard_no}: image_id {min_id}..{max_id} ({count} images)")
+    print(f"Embedding with {workers} worker processes x {threads} threads")
+    
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        futures = [
+            executor.submit(embed_shard, shard_no, min_id, max_id, count, threads,
+                            cores[shard_no * threads:(shard_no + 1) * threads], batch_size, resume)
+            for shard_no, (min_id, max_id, count) in enumerate(shards)
+        ]
+        processed_count = sum(future.result() for future in futures)
+    
+    print(f"\nAll shards done: {processed_count} images embedded")
+    
+    store = merge_shards(workers, watermark)
+    build_index_from_store(store, watermark)
+    store.finish_build()
+    shutil.rmtree(os.path.join(EMBEDDING_STORE_DIR, 'shards'), ignore_errors=True)
+
+def build_index_from_store(store: EmbeddingStore = None, watermark: int = None):
+    store = store or open_store()
+    image_ids, product_ids, image_urls, vectors = store.read()
+    keep = latest_positions(image_ids)
+    
+    if len(keep) == 0:
         print("No vectors to index!")
         return
     
-    vectors_array = np.array(vectors, dtype=np.float32)
-    dimension = vectors_array.shape[1]
+    dimension = store.dimension
+    
+    params = index_params_from_config()
     
-    print(f"Building FAISS index (dimension: {dimension})...")
-    index = faiss.IndexFlatL2(dimension)
-    index.add(vectors_array)
+    print(f"Building {params['index_type']} FAISS index from {store.path} "
+          f"({len(keep)} vectors, dimension: {dimension})...")
+    index = create_index(dimension, params, len(keep))
     
-    os.makedirs(os.path.dirname(FAISS_INDEX_PATH), exist_ok=True)
+    if needs_training(params):
+        rng = np.random.default_rng(0)
+        sample = np.sort(rng.choice(keep, size=min(INDEX_TRAIN_SAMPLE, len(keep)), replace=False))
+        print(f"Training on {len(sample)} sampled vectors (nlist={params['nlist']})...")
+        train_index(index, vectors[sample])
     
-    print(f"Saving index to {FAISS_INDEX_PATH}...")
-    faiss.write_index(index, FAISS_INDEX_PATH)
+    for start in range(0, len(keep), INDEX_ADD_CHUNK):
+        positions = keep[start:start + INDEX_ADD_CHUNK]
+        index.add_with_ids(np.ascontiguousarray(vectors[positions]), image_ids[positions])
     
-    print(f"Saving metadata to {METADATA_PATH}...")
-    np.save(METADATA_PATH, metadata)
+    metadata = MetadataTable.from_rows(image_ids[keep], product_ids[keep], [image_urls[i] for i in keep])
+    
+    if watermark is None:
+        watermark = load_state().get('watermark', int(image_ids.max()))
+    save_index(index, metadata, watermark, params, store)
     
     print("Indexing complete!")
     print(f"Total vectors: {index.ntotal}")
 
+def update_index(batch_size: int = INDEX_BATCH_SIZE):
+    current = snapshots.resolve()
+    state = current.manifest
+    
+    has_metadata = MetadataTable.exists(current.metadata_dir) or (
+        current.legacy_metadata_path is not None and os.path.exists(current.legacy_metadata_path))
+    if not current.exists() or not has_metadata:
+        print("No existing index found, running full build instead")
+        return build_index(batch_size)
+    
+    if state.get('model_name', MODEL_NAME) != MODEL_NAME:
+        print(f"Index was built with {state['model_name']}, not {MODEL_NAME}. Run a full build.")
+        return
+    
+    index = faiss.read_index(current.index_path)
+    if not isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        print("Existing index is positional (built before delta support). Run a full build once.")
+        return
+    
+    if MetadataTable.exists(current.metadata_dir):
+        metadata = MetadataTable.load(current.metadata_dir, mmap=False)
+    else:
+        metadata = MetadataTable.from_legacy(current.legacy_metadata_path)
+    meta_ids = metadata.image_ids
+    meta_product_ids = metadata.product_ids
+    meta_urls = metadata.urls(np.arange(len(metadata)))
+    watermark = state.get('watermark', 0)
+    
+    indexed_ids = faiss.vector_to_array(index.id_map)
+    indexed = set(indexed_ids.tolist())
+    
+    # Only the id column and the not-yet-indexed rows are kept in memory.
+    active_ids = []
+    pending = []
+    for row in iter_images():
+        active_ids.append(row[0])
+        if row[0] not in indexed:
+            pending.append(row)
+    active_ids = np.array(active_ids, dtype=np.int64)
+    
+    stale_ids = np.setdiff1d(indexed_ids, active_ids)
+    new_count = sum(1 for row in pending if row[0] > watermark)
+    
+    print(f"Watermark: image_id {watermark}")
+    print(f"New images since watermark: {new_count}")
+    print(f"Active images missing from index (re-activated or previously failed): {len(pending) - new_count}")
+    print(f"Inactive or deleted images to drop: {len(stale_ids)}")
+    
+    store = open_store()
+    if store.build_status == 'running':
+        print("A full build was interrupted; finish it with --resume before running --delta")
+        return
+    if len(store) < index.ntotal:
+        print(f"Embedding store has {len(store)} vectors for {index.ntotal} indexed images; "
+              "run a full build to backfill it before using --from-store")
+    
+    params = load_params(current.params_path)
+    rebuild = False
+    
+    if len(stale_ids) > 0:
+        # Only a flat inner index renumbers its rows in step with IndexIDMap2's
+        # compacted id_map. IVF lists keep their old sequential ids (and hand
+        # out colliding ones to new vectors) and HNSW graphs cannot delete, so
+        # those are rebuilt from the store below, which needs no model work.
+        if isinstance(inner_index(index), faiss.IndexFlat):
+            index.remove_ids(faiss.IDSelectorBatch(stale_ids))
+        else:
+            print(f"{params['index_type']} index does not support removal, rebuilding from the embedding store")
+            rebuild = True
+        keep = ~np.isin(meta_ids, stale_ids)
+        meta_ids, meta_product_ids = meta_ids[keep], meta_product_ids[keep]
+        meta_urls = [url for url, k in zip(meta_urls, keep) if k]
+    store.drop(np.setdiff1d(store.read()[0], active_ids))
+    store.forget_failures(np.setdiff1d([f['image_id'] for f in store.failures()], active_ids))
+    
+    if pending:
+        # Vectors committed by an interrupted delta run are reused, not re-embedded.
+        stored = set(store.read()[0].tolist())
+        to_embed = [row for row in pending if row[0] not in stored]
+        if len(to_embed) < len(pending):
+            print(f"Reusing {len(pending) - len(to_embed)} embeddings already in the store")
+        
+        if to_embed:
+            preprocessor, model, device = load_model()
+            embed_images(to_embed, preprocessor, model, device, store, batch_size)
+        
+        image_ids, product_ids, image_urls, vectors = store.read()
+        positions = latest_positions(image_ids)
+        positions = positions[np.isin(image_ids[positions], [row[0] for row in pending])]
+        if len(positions) > 0 and not rebuild:
+            index.add_with_ids(np.ascontiguousarray(vectors[positions]), image_ids[positions])
+            meta_ids = np.concatenate([meta_ids, image_ids[positions]])
+            meta_product_ids = np.concatenate([meta_product_ids, product_ids[positions]])
+            meta_urls.extend(image_urls[i] for i in positions)
+    
+    if len(active_ids) > 0:
+        watermark = max(watermark, int(active_ids.max()))
+    
+    if rebuild:
+        return build_index_from_store(store, watermark)
+    save_index(index, MetadataTable.from_rows(meta_ids, meta_product_ids, meta_urls), watermark, params, store)
+    
+    print("Delta indexing complete!")
+    print(f"Total vectors: {index.ntotal}")
+
+def retry_failed(batch_size: int = INDEX_BATCH_SIZE):
+    store = open_store()
+    if store.build_status == 'running':
+        print("A full build was interrupted; finish it with --resume before running --retry-failed")
+        return
+    
+    stored = set(store.read()[0].tolist())
+    failed = {f['image_id'] for f in store.failures() if f['image_id'] not in stored}
+    if not failed:
+        print("No failed images to retry")
+        return
+    
+    # The index is rebuilt from the whole store, so images deactivated or
+    # deleted since they were embedded or failed are dropped from it first
+    # and never re-embedded; the rows come from the database, not the log.
+    active_ids = []
+    rows = []
+    for row in iter_images():
+        active_ids.append(row[0])
+        if row[0] in failed:
+            rows.append(row)
+    active_ids = np.array(active_ids, dtype=np.int64)
+    store.drop(np.setdiff1d(store.read()[0], active_ids))
+    store.forget_failures(np.setdiff1d(list(failed), active_ids))
+    
+    if not rows:
+        print("No failed images to retry")
+        return
+    
+    print(f"Retrying {len(rows)} failed images")
+    
+    preprocessor, model, device = load_model()
+    embedded = embed_images(rows, preprocessor, model, device, store, batch_size)
+    # Only now are the recovered images dropped from the log; images that
+    # failed again keep their (new) entry.
+    store.forget_failures(store.read()[0])
+    if embedded > 0:
+        build_index_from_store(store)
+
+def main():
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='Build the FAISS image index')
+    parser.add_argument('--delta', action='store_true',
+                       help='Only embed images added since the last run and drop inactive ones')
+    parser.add_argument('--from-store', action='store_true',
+                       help='Rebuild the FAISS index from stored embeddings, without downloads or the model')
+    parser.add_argument('--workers', type=int, default=INDEX_WORKERS,
+                       help='Embed in N CPU worker processes over id-range shards, then merge')
+    parser.add_argument('--resume', action='store_true',
+                       help='Continue an interrupted full or sharded build from its last checkpoint')
+    parser.add_argument('--retry-failed', action='store_true',
+                       help='Re-download and embed only the images that failed in earlier runs')
+    parser.add_argument('--batch-size', type=int, default=INDEX_BATCH_SIZE,
+                       help='Images per model forward pass')
+    parser.add_argument('--refresh-attributes', action='store_true',
+                       help='Only reload category / price / stock filter columns from the database')
+    args = parser.parse_args()
+    
+    if args.refresh_attributes:
+        refresh_attributes()
+    elif args.from_store:
+        if open_store().build_status == 'running':
+            print("A full build was interrupted; finish it with --resume before running --from-store")
+        else:
+            build_index_from_store()
+    elif args.retry_failed:
+        retry_failed(args.batch_size)
+    elif args.delta:
+        update_index(args.batch_size)
+    elif args.workers > 1:
+        build_index_sharded(args.workers, args.batch_size, args.resume)
+    else:
+        build_index(args.batch_size, args.resume)
+
 if __name__ == "__main__":
-    build_index()
+    main()
@@ -1,18 +1,46 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Header, Depends
+from fastapi import FastAPI, File, UploadFile, HTTPException, Header, Depends, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from PIL import Image
 import numpy as np
 import faiss
 import torch
 from transformers import AutoFeatureExtractor, AutoModel
-from io import BytesIO
 import time
-from typing import List, Dict, Any, Optional
-from config import API_KEY, MODEL_NAME, FAISS_INDEX_PATH, METADATA_PATH
+import json
+import asyncio
+import hashlib
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple
+from pydantic import BaseModel, Field
+from config import (
+    API_KEY, MODEL_NAME, INDEX_MMAP, SEARCH_MODE, PRODUCT_CANDIDATES, INDEX_VERSION, INDEX_VERIFY_CHECKSUMS,
+    BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS, INFERENCE_WORKERS, INFERENCE_QUEUE_SIZE,
+    QUERY_CACHE_SIZE, QUERY_CACHE_TTL, EMBEDDING_CACHE_SIZE, BATCH_SEARCH_CHUNK, BATCH_SEARCH_MAX_IMAGES,
+    URL_SEARCH_MAX_URLS, MAX_UPLOAD_BYTES, MAX_BATCH_UPLOAD_BYTES
+)
+from preprocessing import ImagePreprocessor
+from metadata_store import MetadataTable
+from search_filters import FilterBitmaps
+from encoders import load_encoder
+from batching import MicroBatcher, Overloaded, Disconnected
+from query_cache import LRUCache
+from uploads import iter_query_images, UploadLimitMiddleware
+from url_fetch import ImageFetcher, FetchError
+import ann_index
+import snapshots
+from ann_index import load_params, search_parameters
 import os
 
 app = FastAPI(title="Image Search Service", version="1.0.0")
 
+app.add_middleware(
+    UploadLimitMiddleware,
+    limits={'/search': MAX_UPLOAD_BYTES, '/search/batch': MAX_BATCH_UPLOAD_BYTES}
+)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -21,84 +49,361 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-class SearchEngine:
-    def __init__(self):
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+class SearchBundle:
+    # Everything one query needs: model, index, metadata and derived lookups.
+    # A bundle's model, index and metadata are never modified after load(),
+    # only its thread-safe caches fill up; reloads build a new one.
+    def __init__(self, device: torch.device):
+        self.device = device
+        self.version = None
+        self.model_name = None
         self.feature_extractor = None
-        self.model = None
+        self.preprocessor = None
+        self.encoder = None
         self.index = None
         self.metadata = None
-        self.is_loaded = False
+        self.index_params = None
+        self.id_map = None
+        self.filters = None
+        self.reconstructable = False
+        self.product_index = None
+        self.product_order = None
+        self.sorted_product_ids = None
+        self.result_cache = None
+        self.embedding_cache = None
     
-    def load(self):
-        if self.is_loaded:
-            return
+    def load(self, previous: Optional['SearchBundle'] = None, version: Optional[str] = None):
+        snapshot = snapshots.resolve(version)
+        if not snapshot.exists():
+            raise FileNotFoundError(f"FAISS index not found at {snapshot.index_path}. Run indexing.py first.")
+        snapshot.verify(full=INDEX_VERIFY_CHECKSUMS)
+        self.version = snapshot.version
+        
+        # The model the index was built with, as recorded in its manifest.
+        self.model_name = snapshot.manifest.get('model_name', MODEL_NAME)
+        if previous is not None and previous.model_name == self.model_name:
+            self.feature_extractor = previous.feature_extractor
+            self.preprocessor = previous.preprocessor
+            self.encoder = previous.encoder
+            self.embedding_cache = previous.embedding_cache
+        else:
+            print(f"Loading model: {self.model_name}")
+            self.feature_extractor = AutoFeatureExtractor.from_pretrained(self.model_name)
+            self.preprocessor = ImagePreprocessor(self.feature_extractor)
+            model = AutoModel.from_pretrained(self.model_name).to(self.device)
+            model.eval()
+            self.encoder = load_encoder(self.model_name, model, self.device, self.preprocessor.input_size)
+            print(f"Inference backend: {self.encoder.backend}")
+            self.embedding_cache = LRUCache(EMBEDDING_CACHE_SIZE, QUERY_CACHE_TTL)
+        
+        # Results depend on the index, so every load starts with an empty cache;
+        # query embeddings only depend on the model and survive reloads.
+        self.result_cache = LRUCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
         
-        print(f"Loading model: {MODEL_NAME}")
-        self.feature_extractor = AutoFeatureExtractor.from_pretrained(MODEL_NAME)
-        self.model = AutoModel.from_pretrained(MODEL_NAME).to(self.device)
-        self.model.eval()
+        legacy_metadata = snapshot.legacy_metadata_path
+        if not MetadataTable.exists(snapshot.metadata_dir) and not (legacy_metadata and os.path.exists(legacy_metadata)):
+            raise FileNotFoundError(f"Metadata not found at {snapshot.metadata_dir}. Run indexing.py first.")
         
-        if not os.path.exists(FAISS_INDEX_PATH):
-            raise FileNotFoundError(f"FAISS index not found at {FAISS_INDEX_PATH}. Run indexing.py first.")
+        print(f"Loading FAISS index from {snapshot.index_path}")
+        self.index = ann_index.read_index(snapshot.index_path)
+        self.index_params = load_params(snapshot.params_path)
         
-        if not os.path.exists(METADATA_PATH):
-            raise FileNotFoundError(f"Metadata not found at {METADATA_PATH}. Run indexing.py first.")
+        if MetadataTable.exists(snapshot.metadata_dir):
+            print(f"Loading metadata from {snapshot.metadata_dir}")
+            self.metadata = MetadataTable.load(snapshot.metadata_dir, mmap=INDEX_MMAP)
+        else:
+            print(f"Loading legacy metadata from {legacy_metadata}")
+            self.metadata = MetadataTable.from_legacy(legacy_metadata)
         
-        print(f"Loading FAISS index from {FAISS_INDEX_PATH}")
-        self.index = faiss.read_index(FAISS_INDEX_PATH)
+        # ID-mapped indexes return image_id labels; older flat indexes return
+        # row positions into the legacy metadata.npy order.
+        if isinstance(self.index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+            self.id_map = faiss.vector_to_array(self.index.id_map)
+        else:
+            legacy = np.load(legacy_metadata, allow_pickle=True)
+            self.id_map = np.array([int(meta['image_id']) for meta in legacy], dtype=np.int64)
         
-        print(f"Loading metadata from {METADATA_PATH}")
-        self.metadata = np.load(METADATA_PATH, allow_pickle=True)
+        self.filters = None
+        if FilterBitmaps.available(self.metadata):
+            self.filters = FilterBitmaps(self.metadata, self.id_map)
+        else:
+            print("Metadata has no filter attributes; filtered search is disabled")
         
-        self.is_loaded = True
-        print(f"Search engine loaded. Total indexed images: {self.index.ntotal}")
+        # Product re-ranking and "more like this" read stored vectors back by
+        # image_id, which needs image_id labels (IndexIDMap2).
+        self.reconstructable = isinstance(self.index, faiss.IndexIDMap2)
+        if self.reconstructable:
+            ann_index.enable_reconstruct(self.index)
+            self.product_order = np.argsort(self.metadata.product_ids, kind='stable')
+            self.sorted_product_ids = self.metadata.product_ids[self.product_order]
+        
+        self.product_index = None
+        if os.path.exists(snapshot.product_index_path) and self.reconstructable:
+            print(f"Loading product centroids from {snapshot.product_index_path}")
+            self.product_index = ann_index.read_index(snapshot.product_index_path)
+        
+        print(f"Search engine loaded. Version: {self.version or 'unversioned'}, "
+              f"index type: {self.index_params['index_type']}, "
+              f"total indexed images: {self.index.ntotal}")
     
-    def extract_features(self, image: Image.Image) -> np.ndarray:
-        inputs = self.feature_extractor(images=image, return_tensors="pt").to(self.device)
+    def validate(self):
+        hidden_size = self.encoder.hidden_size
+        if self.index.d != hidden_size:
+            raise ValueError(f"Index dimension {self.index.d} does not match {self.model_name} ({hidden_size})")
+        if self.index.ntotal == 0:
+            raise ValueError("Index is empty")
         
-        with torch.no_grad():
-            outputs = self.model(**inputs)
-            features = outputs.last_hidden_state[:, 0, :].cpu().numpy()
+        missing = int((self.metadata.rows(self.id_map) < 0).sum())
+        if missing:
+            raise ValueError(f"{missing} indexed images have no metadata")
         
-        return features.flatten()
+        # One end-to-end query so a broken bundle never starts serving.
+        self.search_products(Image.new('RGB', self.preprocessor.input_size), limit=1)
+    
+    def embed(self, images: List[Image.Image]) -> np.ndarray:
+        return self.encoder(self.preprocessor(images))
+    
+    def _search_params(self, nprobe: Optional[int], ef_search: Optional[int], selector=None):
+        if nprobe or ef_search or selector is not None:
+            return search_parameters(self.index_params, nprobe, ef_search, selector)
+        return None
+    
+    def _hits(self, labels: np.ndarray, distances: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        rows = self.metadata.rows(labels)
+        found = rows >= 0
+        return rows[found], distances[found]
+    
+    def _results(self, rows: np.ndarray, distances: np.ndarray) -> List[Dict[str, Any]]:
+        return [
+            {
+                'product_id': product_id,
+                'image_url': image_url,
+                'distance': distance,
+                'similarity_score': score
+            }
+            for product_id, image_url, distance, score in zip(
+                self.metadata.product_ids[rows].tolist(),
+                self.metadata.urls(rows),
+                distances.tolist(),
+                (1 / (1 + distances)).tolist()
+            )
+        ]
+    
+    def search_products(self, image: Image.Image, limit: int = 10, top_k: int = 50,
+                        nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                        filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        return self.search_products_batch(self.embed([image]), limit, top_k, nprobe, ef_search, filters)[0]
     
-    def search(self, image: Image.Image, top_k: int = 50) -> List[Dict[str, Any]]:
-        query_vector = self.extract_features(image)
-        query_vector = np.array([query_vector], dtype=np.float32)
+    def search_products_batch(self, query_vectors: np.ndarray, limit: int = 10, top_k: int = 50,
+                              nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                              filters: Optional[Dict[str, Any]] = None) -> List[List[Dict[str, Any]]]:
+        # All queries share one multi-query search at top_k. A query that still
+        # has fewer than `limit` distinct products is widened on its own by
+        # doubling k, so products with many near-identical images cannot
+        # shrink the page.
+        ntotal = self.index.ntotal
+        selector = None
+        if filters:
+            if self.filters is None:
+                raise ValueError("Filtered search needs filter attributes; run indexing.py --refresh-attributes")
+            # The selector only points at bitmap, which must stay referenced here.
+            bitmap = self.filters.build(**filters)
+            if bitmap is not None:
+                ntotal = self.filters.count(bitmap)
+                selector = ann_index.bitmap_selector(bitmap)
         
-        distances, indices = self.index.search(query_vector, top_k)
+        if ntotal == 0:
+            return [[] for _ in range(len(query_vectors))]
+        
+        search_params = self._search_params(nprobe, ef_search, selector)
+        start_k = min(max(top_k, limit), ntotal)
+        all_distances, all_labels = ann_index.search(self.index, self.id_map, query_vectors, start_k, search_params)
         
         results = []
-        for idx, distance in zip(indices[0], distances[0]):
-            if idx < len(self.metadata):
-                meta = self.metadata[idx]
-                results.append({
-                    'product_id': int(meta['product_id']),
-                    'image_url': meta['image_url'],
-                    'distance': float(distance),
-                    'similarity_score': float(1 / (1 + distance))
-                })
+        for query_no in range(len(query_vectors)):
+            k = start_k
+            labels, distances = all_labels[query_no], all_distances[query_no]
+            while True:
+                rows, hit_distances = self._hits(labels, distances)
+                first = first_per_product(self.metadata.product_ids[rows])
+                # Fewer hits than asked means the index (e.g. IVF at this nprobe) has no more to give.
+                if len(first) >= limit or k >= ntotal or len(rows) < k:
+                    break
+                k = min(k * 2, ntotal)
+                distances, labels = ann_index.search(self.index, self.id_map,
+                                                     query_vectors[query_no:query_no + 1], k, search_params)
+                labels, distances = labels[0], distances[0]
+            
+            first = first[:limit]
+            results.append(self._results(rows[first], hit_distances[first]))
         
         return results
     
-    def deduplicate_by_product(self, results: List[Dict[str, Any]], limit: int = 10) -> List[Dict[str, Any]]:
-        seen_products = set()
-        unique_results = []
+    def search_product_centroids_batch(self, query_vectors: np.ndarray, limit: int = 10,
+                                       candidates: int = PRODUCT_CANDIDATES) -> List[List[Dict[str, Any]]]:
+        # Stage 1 ranks product centroids; stage 2 scores only the images of the
+        # candidate products exactly and keeps each product's best image.
+        k = min(max(candidates, limit), self.product_index.ntotal)
+        if k == 0:
+            return [[] for _ in range(len(query_vectors))]
+        _, all_labels = self.product_index.search(query_vectors, k)
         
-        for result in results:
-            product_id = result['product_id']
-            if product_id not in seen_products:
-                seen_products.add(product_id)
-                unique_results.append(result)
+        results = []
+        for query_vector, labels in zip(query_vectors, all_labels):
+            rows = self.product_rows(labels[labels >= 0])
+            if len(rows) == 0:
+                results.append([])
+                continue
+            
+            vectors = self.stored_vectors(self.metadata.image_ids[rows])
+            distances = ((vectors - query_vector) ** 2).sum(axis=1)
             
-            if len(unique_results) >= limit:
-                break
+            order = np.argsort(distances, kind='stable')
+            rows, distances = rows[order], distances[order]
+            first = first_per_product(self.metadata.product_ids[rows])[:limit]
+            results.append(self._results(rows[first], distances[first]))
         
-        return unique_results
+        return results
+    
+    def search_batch(self, query_vectors: np.ndarray, mode: str = 'image', limit: int = 10,
+                     nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                     filters: Optional[Dict[str, Any]] = None) -> List[List[Dict[str, Any]]]:
+        # Filters are applied over image vectors, so filtered queries always use image mode.
+        if mode == 'product' and not filters:
+            if self.product_index is None:
+                raise ValueError("Product index not built; run indexing.py first")
+            return self.search_product_centroids_batch(query_vectors, limit=limit)
+        return self.search_products_batch(query_vectors, limit=limit, top_k=50,
+                                          nprobe=nprobe, ef_search=ef_search, filters=filters)
+    
+    def product_rows(self, product_ids: np.ndarray) -> np.ndarray:
+        # Metadata rows of every image of the given products, product by product.
+        starts = np.searchsorted(self.sorted_product_ids, product_ids, side='left')
+        ends = np.searchsorted(self.sorted_product_ids, product_ids, side='right')
+        if (ends - starts).sum() == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([self.product_order[start:end] for start, end in zip(starts, ends)])
+    
+    def stored_vectors(self, image_ids: np.ndarray) -> np.ndarray:
+        return np.vstack([self.index.reconstruct(image_id) for image_id in image_ids.tolist()])
+    
+    def search_similar(self, kind: str, source_id: int, mode: str = 'image', limit: int = 10,
+                       nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                       filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        # "More like this" from vectors already in the index: an image's own
+        # vector, or the mean of a product's image vectors. No model inference.
+        if kind == 'image':
+            rows = self.metadata.rows([source_id])
+            rows = rows[rows >= 0]
+        else:
+            rows = self.product_rows(np.array([source_id], dtype=np.int64))
+        if len(rows) == 0:
+            raise KeyError(f"{kind} {source_id} is not indexed")
+        
+        try:
+            vectors = self.stored_vectors(self.metadata.image_ids[rows])
+        except RuntimeError:
+            raise KeyError(f"{kind} {source_id} is not indexed")
+        query_vector = np.ascontiguousarray(vectors.mean(axis=0, keepdims=True), dtype=np.float32)
+        
+        # One extra product so the page is still full once the source is dropped.
+        source_product = int(self.metadata.product_ids[rows[0]])
+        results = self.search_batch(query_vector, mode, limit + 1, nprobe, ef_search, filters)[0]
+        return [result for result in results if result['product_id'] != source_product][:limit]
+
+def first_per_product(product_ids: np.ndarray) -> np.ndarray:
+    # Positions of the best-ranked hit of every product, in rank order.
+    _, first = np.unique(product_ids, return_index=True)
+    return np.sort(first)
+
+class SearchEngine:
+    # Holds the bundle that serves queries. Handlers read `bundle` once per
+    # request; reload() swaps in a fully loaded and validated replacement.
+    def __init__(self):
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.bundle = None
+        self.reload_lock = threading.Lock()
+    
+    @property
+    def is_loaded(self) -> bool:
+        return self.bundle is not None
+    
+    def load(self, version: Optional[str] = None) -> SearchBundle:
+        with self.reload_lock:
+            bundle = SearchBundle(self.device)
+            bundle.load(previous=self.bundle, version=version or INDEX_VERSION)
+            bundle.validate()
+            self.bundle = bundle
+            return bundle
 
 search_engine = SearchEngine()
 
+class InvalidImage(ValueError):
+    pass
+
+def search_options_key(options: Dict[str, Any]) -> tuple:
+    filters = options.get('filters')
+    return (options['mode'], options['limit'], options.get('nprobe'), options.get('ef_search'),
+            tuple(sorted(filters.items())) if filters else None)
+
+def run_search_batch(requests: List[Dict[str, Any]]) -> List[Any]:
+    # Decoding, one forward pass for every image in the batch not already in
+    # the embedding cache, then one multi-query search per group of requests
+    # that share the same options. Runs on the inference executor, never on
+    # the event loop.
+    bundle = search_engine.bundle
+    results: List[Any] = [None] * len(requests)
+    vectors: Dict[int, np.ndarray] = {}
+    
+    images, decoded = [], []
+    for i, request in enumerate(requests):
+        vector = bundle.embedding_cache.get(request['digest'])
+        if vector is not None:
+            vectors[i] = vector
+            continue
+        try:
+            images.append(bundle.preprocessor.decode(request['contents']))
+            decoded.append(i)
+        except Exception as e:
+            results[i] = InvalidImage(str(e))
+    
+    if images:
+        for i, vector in zip(decoded, bundle.embed(images)):
+            vectors[i] = vector.copy()
+            bundle.embedding_cache.put(requests[i]['digest'], vectors[i])
+    
+    groups = {}
+    for i in vectors:
+        groups.setdefault(search_options_key(requests[i]['options']), []).append(i)
+    
+    for key, members in groups.items():
+        try:
+            group_results = bundle.search_batch(np.stack([vectors[i] for i in members]), **requests[members[0]]['options'])
+        except Exception as e:
+            group_results = [e] * len(members)
+        for i, result in zip(members, group_results):
+            results[i] = result
+            if not isinstance(result, Exception):
+                bundle.result_cache.put((requests[i]['digest'], key), result)
+    
+    return results
+
+# Concurrent forward passes split the CPU cores instead of oversubscribing them.
+if INFERENCE_WORKERS > 1:
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // INFERENCE_WORKERS))
+
+inference_executor = ThreadPoolExecutor(max_workers=max(1, INFERENCE_WORKERS), thread_name_prefix="inference")
+search_batcher = MicroBatcher(
+    run_search_batch,
+    max_batch_size=BATCH_MAX_SIZE,
+    max_wait_ms=BATCH_MAX_WAIT_MS,
+    executor=inference_executor,
+    concurrency=INFERENCE_WORKERS,
+    max_queue=INFERENCE_QUEUE_SIZE
+)
+
+image_fetcher = ImageFetcher()
+
 def verify_api_key(x_api_key: Optional[str] = Header(None)):
     if not API_KEY:
         return True
@@ -108,8 +413,15 @@ def verify_api_key(x_api_key: Optional[str] = Header(None)):
     
     return True
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    await search_batcher.stop()
+    inference_executor.shutdown(wait=False)
+    await image_fetcher.aclose()
+
 @app.on_event("startup")
 async def startup_event():
+    search_batcher.start()
     try:
         search_engine.load()
     except Exception as e:
@@ -122,67 +434,342 @@ async def root():
         "service": "Image Search Service",
         "version": "1.0.0",
         "status": "running",
-        "indexed_images": search_engine.index.ntotal if search_engine.is_loaded else 0
+        "indexed_images": search_engine.bundle.index.ntotal if search_engine.is_loaded else 0
     }
 
 @app.get("/health")
 async def health_check():
+    bundle = search_engine.bundle
     return {
         "status": "healthy",
-        "model_loaded": search_engine.is_loaded,
-        "indexed_images": search_engine.index.ntotal if search_engine.is_loaded else 0
+        "model_loaded": bundle is not None,
+        "model_name": bundle.model_name if bundle else None,
+        "inference_backend": bundle.encoder.backend if bundle else None,
+        "index_version": bundle.version if bundle else None,
+        "index_type": bundle.index_params['index_type'] if bundle else None,
+        "product_index": bundle is not None and bundle.product_index is not None,
+        "reloading": search_engine.reload_lock.locked(),
+        "batching": search_batcher.stats(),
+        "cache": {
+            "results": bundle.result_cache.stats(),
+            "embeddings": bundle.embedding_cache.stats()
+        } if bundle else None,
+        "indexed_images": bundle.index.ntotal if bundle else 0
     }
 
+def search_options(
+    nprobe: Optional[int] = Query(None, ge=1, description="IVF lists to visit (ivf_flat / ivf_pq)"),
+    ef_search: Optional[int] = Query(None, ge=1, description="HNSW search depth (hnsw)"),
+    limit: int = Query(10, ge=1, le=100, description="Number of distinct products to return"),
+    category_id: Optional[int] = Query(None, description="Only products in this category"),
+    min_price: Optional[float] = Query(None, ge=0, description="Minimum selling price"),
+    max_price: Optional[float] = Query(None, ge=0, description="Maximum selling price"),
+    in_stock: bool = Query(False, description="Only images whose variant has available stock"),
+    mode: str = Query(SEARCH_MODE, description="image: scan image vectors; product: product centroids, then re-rank")
+) -> Dict[str, Any]:
+    filters = None
+    if category_id is not None or min_price is not None or max_price is not None or in_stock:
+        filters = {'category_id': category_id, 'min_price': min_price, 'max_price': max_price, 'in_stock': in_stock}
+    if mode not in ('image', 'product'):
+        raise HTTPException(status_code=400, detail="mode must be 'image' or 'product'")
+    return {'mode': mode, 'limit': limit, 'nprobe': nprobe, 'ef_search': ef_search, 'filters': filters}
+
+def loaded_bundle(options: Dict[str, Any]) -> SearchBundle:
+    # The bundle serving this request, checked against what the options need.
+    bundle = search_engine.bundle
+    if bundle is None:
+        raise HTTPException(
+            status_code=503,
+            detail="Search engine not loaded. Please run indexing.py first."
+        )
+    
+    if options['mode'] == 'product' and bundle.product_index is None:
+        raise HTTPException(status_code=400, detail="Product index not built; run indexing.py first")
+    
+    if options['filters'] and bundle.filters is None:
+        raise HTTPException(
+            status_code=400,
+            detail="Filters are not available: run indexing.py --refresh-attributes and reload"
+        )
+    return bundle
+
 @app.post("/search")
 async def search_image(
+    request: Request,
     file: UploadFile = File(...),
+    options: Dict[str, Any] = Depends(search_options),
     _: bool = Depends(verify_api_key)
 ):
     start_time = time.time()
-    
-    if not search_engine.is_loaded:
-        raise HTTPException(
-            status_code=503,
-            detail="Search engine not loaded. Please run indexing.py first."
-        )
+    bundle = loaded_bundle(options)
     
     if file.content_type and not file.content_type.startswith('image/'):
         raise HTTPException(status_code=400, detail="File must be an image")
     
-    try:
-        contents = await file.read()
-        image = Image.open(BytesIO(contents)).convert('RGB')
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Invalid image file: {str(e)}")
+    contents = await file.read()
+    digest = hashlib.sha256(contents).hexdigest()
+    
+    # Repeat uploads (retries, back-navigation) are answered from the cache.
+    unique_results = bundle.result_cache.get((digest, search_options_key(options)))
+    cached = unique_results is not None
     
     try:
-        raw_results = search_engine.search(image, top_k=50)
-        unique_results = search_engine.deduplicate_by_product(raw_results, limit=10)
+        if not cached:
+            unique_results = await search_batcher.submit({
+                'contents': contents,
+                'digest': digest,
+                'options': options
+            }, is_disconnected=request.is_disconnected)
         
         query_time_ms = int((time.time() - start_time) * 1000)
         
         return {
             "success": True,
             "results": unique_results,
+            "cached": cached,
             "query_time_ms": query_time_ms
         }
     
+    except Overloaded:
+        raise HTTPException(status_code=503, detail="Search is overloaded, retry shortly", headers={"Retry-After": "1"})
+    except Disconnected:
+        # Nobody is left to read the response (nginx's "client closed request").
+        return Response(status_code=499)
+    except InvalidImage as e:
+        raise HTTPException(status_code=400, detail=f"Invalid image file: {str(e)}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Search failed: {str(e)}")
+
+class UrlSearchRequest(BaseModel):
+    urls: List[str] = Field(..., min_length=1, max_length=URL_SEARCH_MAX_URLS)
+
+async def search_url(url: str, options: Dict[str, Any], bundle: SearchBundle) -> Dict[str, Any]:
+    try:
+        contents = await image_fetcher.fetch(url)
+        digest = hashlib.sha256(contents).hexdigest()
+        results = bundle.result_cache.get((digest, search_options_key(options)))
+        if results is None:
+            results = await search_batcher.submit({'contents': contents, 'digest': digest, 'options': options})
+        return {"url": url, "success": True, "results": results}
+    except (FetchError, InvalidImage) as e:
+        return {"url": url, "success": False, "error": str(e)}
+
+@app.post("/search/url")
+async def search_image_url(
+    body: UrlSearchRequest,
+    options: Dict[str, Any] = Depends(search_options),
+    _: bool = Depends(verify_api_key)
+):
+    # The service downloads the images itself, all URLs concurrently over
+    # one pooled client; the fetched images share micro-batches like uploads.
+    start_time = time.time()
+    bundle = loaded_bundle(options)
+    
+    try:
+        results = await asyncio.gather(*[search_url(url, options, bundle) for url in body.urls])
+    except Overloaded:
+        raise HTTPException(status_code=503, detail="Search is overloaded, retry shortly", headers={"Retry-After": "1"})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Search failed: {str(e)}")
+    
+    return {
+        "success": True,
+        "results": results,
+        "query_time_ms": int((time.time() - start_time) * 1000)
+    }
+
+@app.post("/search/batch")
+async def search_image_batch(
+    request: Request,
+    options: Dict[str, Any] = Depends(search_options),
+    _: bool = Depends(verify_api_key)
+):
+    # Multipart field "files": images and/or zip/tar archives of images.
+    # Images are searched in chunks of BATCH_SEARCH_CHUNK (one forward pass
+    # and one multi-query search per chunk) and every result is streamed as
+    # an NDJSON line as soon as its chunk is done, in upload order.
+    start_time = time.time()
+    loaded_bundle(options)
+    
+    # The form is parsed here rather than as a File(...) parameter: FastAPI
+    # closes those uploads when the handler returns, before streaming ends.
+    form = await request.form(max_files=BATCH_SEARCH_MAX_IMAGES)
+    files = [(upload.filename, upload.file) for upload in form.getlist('files') if hasattr(upload, 'file')]
+    if not files:
+        await form.close()
+        raise HTTPException(status_code=400, detail="Upload query images as multipart field 'files'")
+    
+    def next_chunk(images, size: int) -> List[Tuple[str, Optional[bytes], Optional[str]]]:
+        return [
+            (name, data, hashlib.sha256(data).hexdigest() if data is not None else None)
+            for name, data in itertools.islice(images, size)
+        ]
+    
+    async def stream():
+        loop = asyncio.get_running_loop()
+        images = iter_query_images(files, MAX_UPLOAD_BYTES)
+        count = failed = 0
+        try:
+            while True:
+                try:
+                    chunk = await run_in_threadpool(next_chunk, images, min(BATCH_SEARCH_CHUNK, BATCH_SEARCH_MAX_IMAGES - count))
+                except Exception as e:
+                    yield json.dumps({"success": False, "error": f"Unreadable upload: {str(e)}"}) + '\n'
+                    break
+                if not chunk:
+                    break
+                
+                # Straight to the inference executor: a bulk job takes one
+                # worker at a time instead of filling the /search queue.
+                readable = [i for i, (_, data, _) in enumerate(chunk) if data is not None]
+                results: List[Any] = [InvalidImage(f"Image is larger than {MAX_UPLOAD_BYTES} bytes")] * len(chunk)
+                requests = [{'contents': chunk[i][1], 'digest': chunk[i][2], 'options': options} for i in readable]
+                try:
+                    searched = await loop.run_in_executor(inference_executor, run_search_batch, requests) if requests else []
+                except Exception as e:
+                    searched = [e] * len(requests)
+                for i, result in zip(readable, searched):
+                    results[i] = result
+                
+                for (name, _, _), result in zip(chunk, results):
+                    line = {"index": count, "name": name}
+                    if isinstance(result, Exception):
+                        failed += 1
+                        line.update(success=False, error=str(result))
+                    else:
+                        line.update(success=True, results=result)
+                    count += 1
+                    yield json.dumps(line) + '\n'
+            
+            truncated = count >= BATCH_SEARCH_MAX_IMAGES and bool(await run_in_threadpool(next_chunk, images, 1))
+            yield json.dumps({
+                "done": True,
+                "count": count,
+                "failed": failed,
+                "truncated": truncated,
+                "query_time_ms": int((time.time() - start_time) * 1000)
+            }) + '\n'
+        finally:
+            await form.close()
+    
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+async def similar(kind: str, source_id: int, options: Dict[str, Any]) -> Dict[str, Any]:
+    start_time = time.time()
+    bundle = loaded_bundle(options)
+    if not bundle.reconstructable:
+        raise HTTPException(status_code=400, detail="Index does not store vectors by image_id; rebuild it with indexing.py")
+    
+    key = ((kind, source_id), search_options_key(options))
+    results = bundle.result_cache.get(key)
+    cached = results is not None
+    
+    if not cached:
+        try:
+            results = await run_in_threadpool(bundle.search_similar, kind, source_id, **options)
+        except KeyError:
+            raise HTTPException(status_code=404, detail=f"{kind.capitalize()} {source_id} is not indexed")
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Search failed: {str(e)}")
+        bundle.result_cache.put(key, results)
+    
+    return {
+        "success": True,
+        "results": results,
+        "cached": cached,
+        "query_time_ms": int((time.time() - start_time) * 1000)
+    }
+
+@app.get("/similar/image/{image_id}")
+async def similar_to_image(
+    image_id: int,
+    options: Dict[str, Any] = Depends(search_options),
+    _: bool = Depends(verify_api_key)
+):
+    return await similar('image', image_id, options)
+
+@app.get("/similar/product/{product_id}")
+async def similar_to_product(
+    product_id: int,
+    options: Dict[str, Any] = Depends(search_options),
+    _: bool = Depends(verify_api_key)
+):
+    return await similar('product', product_id, options)
 
 @app.post("/reload")
 async def reload_index(_: bool = Depends(verify_api_key)):
+    # The current bundle keeps serving while the new one loads off the event
+    # loop; a failed load or validation leaves it in place.
+    if search_engine.reload_lock.locked():
+        raise HTTPException(status_code=409, detail="A reload is already in progress")
+    
     try:
-        search_engine.is_loaded = False
-        search_engine.load()
+        bundle = await run_in_threadpool(search_engine.load)
         return {
             "success": True,
             "message": "Index reloaded successfully",
-            "indexed_images": search_engine.index.ntotal
+            "version": bundle.version,
+            "model_name": bundle.model_name,
+            "indexed_images": bundle.index.ntotal
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Reload failed: {str(e)}")
 
+@app.get("/versions")
+async def list_versions(_: bool = Depends(verify_api_key)):
+    bundle = search_engine.bundle
+    return {
+        "current": snapshots.current_version(),
+        "loaded": bundle.version if bundle else None,
+        "versions": [
+            {k: v for k, v in snapshot.manifest.items() if k not in ('checksums', 'sizes')}
+            for snapshot in snapshots.versions()
+        ]
+    }
+
+@app.post("/rollback")
+async def rollback_index(
+    version: Optional[str] = Query(None, description="Version to activate; defaults to the one before the loaded version"),
+    _: bool = Depends(verify_api_key)
+):
+    if search_engine.reload_lock.locked():
+        raise HTTPException(status_code=409, detail="A reload is already in progress")
+    
+    available = [snapshot.version for snapshot in snapshots.versions()]
+    if version is None:
+        loaded = search_engine.bundle.version if search_engine.bundle else None
+        older = [v for v in available if loaded is None or v < loaded]
+        if not older:
+            raise HTTPException(status_code=404, detail="No older index version to roll back to")
+        version = older[-1]
+    elif version not in available:
+        raise HTTPException(status_code=404, detail=f"Unknown index version '{version}'")
+    
+    # An older version is rehashed once here, before any worker can load it;
+    # loads themselves only check sizes unless INDEX_VERIFY_CHECKSUMS is set.
+    try:
+        await run_in_threadpool(snapshots.resolve(version).verify, True)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=f"Rollback refused: {str(e)}")
+    
+    # CURRENT is flipped first so other workers and the next --delta see the
+    # same version; it is restored if this worker cannot load it.
+    previous = snapshots.current_version()
+    snapshots.set_current(version)
+    try:
+        bundle = await run_in_threadpool(search_engine.load, version)
+    except Exception as e:
+        if previous:
+            snapshots.set_current(previous)
+        raise HTTPException(status_code=500, detail=f"Rollback failed: {str(e)}")
+    
+    return {
+        "success": True,
+        "version": bundle.version,
+        "previous_version": previous,
+        "indexed_images": bundle.index.ntotal
+    }
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
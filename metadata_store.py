@@ -0,0 +1,136 @@
+import os
+import json
+import shutil
+import numpy as np
+from datetime import datetime, timezone
+from typing import List, Dict
+
+# Columnar image metadata, replacing the pickled list of dicts in metadata.npy.
+# Rows are sorted by image_id so FAISS labels are resolved with searchsorted;
+# image_urls are one UTF-8 blob plus an offsets array. Every column is a plain
+# .npy file that the service opens with mmap_mode='r'.
+
+MANIFEST_FILE = "manifest.json"
+URL_OFFSETS_FILE = "image_url_offsets.npy"
+URL_DATA_FILE = "image_url_data.npy"
+
+# Optional per-image filter attributes: name -> (dtype, value for unknown rows).
+ATTRIBUTE_COLUMNS = {
+    'category_id': (np.int64, -1),
+    'price': (np.float64, np.nan),
+    'stock': (np.int64, 0),
+}
+
+class MetadataTable:
+    def __init__(self, image_ids: np.ndarray, product_ids: np.ndarray,
+                 url_offsets: np.ndarray, url_data: np.ndarray, attributes: Dict[str, np.ndarray] = None):
+        self.image_ids = image_ids
+        self.product_ids = product_ids
+        self.url_offsets = url_offsets
+        self.url_data = url_data
+        self.attributes = attributes or {}
+
+    @classmethod
+    def from_rows(cls, image_ids, product_ids, image_urls: List[str]) -> 'MetadataTable':
+        image_ids = np.asarray(image_ids, dtype=np.int64)
+        order = np.argsort(image_ids, kind='stable')
+
+        encoded = [image_urls[i].encode('utf-8') for i in order]
+        url_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(url) for url in encoded], out=url_offsets[1:])
+        url_data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+        return cls(image_ids[order], np.asarray(product_ids, dtype=np.int64)[order], url_offsets, url_data)
+
+    @classmethod
+    def from_legacy(cls, path: str) -> 'MetadataTable':
+        metadata = np.load(path, allow_pickle=True)
+        return cls.from_rows(
+            [meta['image_id'] for meta in metadata],
+            [meta['product_id'] for meta in metadata],
+            [meta['image_url'] for meta in metadata]
+        )
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> 'MetadataTable':
+        mmap_mode = 'r' if mmap else None
+        columns = [
+            np.load(os.path.join(path, name), mmap_mode=mmap_mode)
+            for name in ('image_id.npy', 'product_id.npy', URL_OFFSETS_FILE, URL_DATA_FILE)
+        ]
+
+        with open(os.path.join(path, MANIFEST_FILE), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        attributes = {
+            name: np.load(os.path.join(path, f"attr_{name}.npy"), mmap_mode=mmap_mode)
+            for name in manifest.get('attributes', [])
+        }
+        return cls(*columns, attributes=attributes)
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(os.path.join(path, MANIFEST_FILE))
+
+    def __len__(self) -> int:
+        return len(self.image_ids)
+
+    def rows(self, image_ids) -> np.ndarray:
+        # Row of every image_id, -1 where it is unknown (or a -1 FAISS label).
+        image_ids = np.asarray(image_ids, dtype=np.int64)
+        if len(self) == 0:
+            return np.full(image_ids.shape, -1, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(self.image_ids, image_ids), len(self) - 1)
+        return np.where(self.image_ids[rows] == image_ids, rows, -1)
+
+    def urls(self, rows) -> List[str]:
+        starts = self.url_offsets[rows].tolist()
+        ends = self.url_offsets[np.asarray(rows) + 1].tolist()
+        data = self.url_data
+        return [bytes(data[start:end]).decode('utf-8') for start, end in zip(starts, ends)]
+
+    def with_attributes(self, image_ids, columns: Dict[str, np.ndarray]) -> 'MetadataTable':
+        # Aligns attribute columns given per image_id to this table's rows;
+        # rows without a value get the column's "unknown" fill.
+        rows = self.rows(image_ids)
+        found = rows >= 0
+
+        attributes = {}
+        for name, values in columns.items():
+            dtype, fill = ATTRIBUTE_COLUMNS[name]
+            column = np.full(len(self), fill, dtype=dtype)
+            column[rows[found]] = np.asarray(values, dtype=dtype)[found]
+            attributes[name] = column
+
+        return MetadataTable(self.image_ids, self.product_ids, self.url_offsets, self.url_data, attributes)
+
+    def save(self, path: str):
+        # Written to a sibling directory and swapped in; processes that still
+        # map the old files keep reading them until they reload.
+        tmp_path = path + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        columns = (
+            ('image_id.npy', self.image_ids),
+            ('product_id.npy', self.product_ids),
+            (URL_OFFSETS_FILE, self.url_offsets),
+            (URL_DATA_FILE, self.url_data),
+        )
+        columns += tuple((f"attr_{name}.npy", data) for name, data in self.attributes.items())
+        for name, data in columns:
+            np.save(os.path.join(tmp_path, name), np.ascontiguousarray(data))
+
+        with open(os.path.join(tmp_path, MANIFEST_FILE), 'w', encoding='utf-8') as f:
+            json.dump({
+                'count': len(self),
+                'columns': [name for name, _ in columns],
+                'attributes': list(self.attributes),
+                'updated_at': datetime.now(timezone.utc).isoformat()
+            }, f, indent=2)
+
+        old_path = path + '.old'
+        shutil.rmtree(old_path, ignore_errors=True)
+        if os.path.exists(path):
+            os.replace(path, old_path)
+        os.replace(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
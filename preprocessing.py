@@ -0,0 +1,101 @@
+import numpy as np
+import torch
+from PIL import Image
+from io import BytesIO
+from typing import List, Tuple
+from config import MAX_IMAGE_PIXELS
+
+# Fast replacement for running AutoFeatureExtractor image by image.
+# JPEGs are decoded in draft mode straight to the smallest DCT scale that still
+# covers the model input, and the batch is converted and normalised as one
+# tensor. Output matches the HF processor within a few grey levels; use
+# max_difference() to check a given model.
+
+RESIZE_REDUCING_GAP = 3.0
+
+def decode_image(data: bytes, size: Tuple[int, int] = (224, 224), max_pixels: int = MAX_IMAGE_PIXELS) -> Image.Image:
+    img = Image.open(BytesIO(data))
+    # Only the header has been read so far: oversized images (decompression
+    # bombs) are rejected before any pixel is decoded.
+    if img.width * img.height > max_pixels:
+        raise ValueError(f"Image has {img.width}x{img.height} pixels, more than {max_pixels}")
+    if img.format == 'JPEG':
+        img.draft('RGB', size)
+
+    # Formats without draft decoding are shrunk with the same integer reduce()
+    # that resize(reducing_gap=...) would apply, but before the RGB conversion.
+    # Palette, 16-bit and other modes reduce() cannot average are converted
+    # first; that is the conversion they would get anyway.
+    factor = int(min(img.width / size[0], img.height / size[1]) / RESIZE_REDUCING_GAP)
+    if factor >= 2:
+        if img.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            img = img.convert('RGB')
+        img = img.reduce(factor)
+    return img.convert('RGB')
+
+class ImagePreprocessor:
+    def __init__(self, feature_extractor):
+        self.feature_extractor = feature_extractor
+
+        size = getattr(feature_extractor, 'size', None) or {}
+        if isinstance(size, dict) and 'height' in size and 'width' in size:
+            self.size = (size['width'], size['height'])
+        else:
+            # Shortest-edge / crop configurations are left to the HF processor.
+            self.size = None
+
+        self.resample = getattr(feature_extractor, 'resample', Image.BICUBIC)
+        self.rescale_factor = getattr(feature_extractor, 'rescale_factor', 1 / 255)
+        self.mean = torch.tensor(feature_extractor.image_mean, dtype=torch.float32).view(1, 3, 1, 1)
+        self.std = torch.tensor(feature_extractor.image_std, dtype=torch.float32).view(1, 3, 1, 1)
+
+    @property
+    def input_size(self) -> Tuple[int, int]:
+        return self.size or (224, 224)
+
+    def decode(self, data: bytes) -> Image.Image:
+        return decode_image(data, self.input_size)
+
+    def __call__(self, images: List[Image.Image]) -> torch.Tensor:
+        if self.size is None:
+            return self.feature_extractor(images=images, return_tensors="pt")['pixel_values']
+
+        pixels = np.stack([
+            np.asarray(img.convert('RGB').resize(self.size, self.resample, reducing_gap=RESIZE_REDUCING_GAP))
+            for img in images
+        ])
+        batch = torch.from_numpy(pixels).permute(0, 3, 1, 2).float()
+        return (batch * self.rescale_factor - self.mean) / self.std
+
+    def max_difference(self, images: List[Image.Image]) -> float:
+        reference = self.feature_extractor(images=images, return_tensors="pt")['pixel_values']
+        return float((self(images) - reference).abs().max())
+
+def main():
+    import argparse
+    from transformers import AutoFeatureExtractor
+    from config import MODEL_NAME
+
+    parser = argparse.ArgumentParser(description='Compare the fast preprocessing path with the HF processor')
+    parser.add_argument('images', nargs='+', help='Image files to compare')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                       help='Maximum allowed mean absolute difference in normalised pixel units')
+    args = parser.parse_args()
+
+    feature_extractor = AutoFeatureExtractor.from_pretrained(MODEL_NAME)
+    preprocessor = ImagePreprocessor(feature_extractor)
+
+    worst = 0.0
+    for path in args.images:
+        with open(path, 'rb') as f:
+            data = f.read()
+        fast = preprocessor([preprocessor.decode(data)])
+        reference = feature_extractor(images=Image.open(BytesIO(data)).convert('RGB'), return_tensors="pt")['pixel_values']
+        diff = (fast - reference).abs()
+        worst = max(worst, float(diff.mean()))
+        print(f"{path}: mean abs diff {float(diff.mean()):.4f}, max {float(diff.max()):.4f}")
+
+    print("OK" if worst <= args.tolerance else f"FAILED: mean difference {worst:.4f} > {args.tolerance}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import numpy as np
+from typing import Optional
+from config import FILTER_CATEGORY_CACHE_SIZE
+from metadata_store import MetadataTable
+from query_cache import LRUCache
+
+# Attribute filters applied inside the FAISS search. Every filter is a packed
+# bitmap over index positions (1 bit per vector) that is ANDed with the others
+# and handed to faiss.IDSelectorBitmap. The stock bitmap is built once per
+# load, price bands per request; category bitmaps are built on first use and
+# kept in a bounded LRU, and an id not in the metadata matches nothing.
+
+class FilterBitmaps:
+    def __init__(self, metadata: MetadataTable, position_ids: np.ndarray):
+        rows = metadata.rows(position_ids)
+        known = rows >= 0
+        rows = np.maximum(rows, 0)
+
+        self.size = len(position_ids)
+        self.category_ids = np.where(known, metadata.attributes['category_id'][rows], -1)
+        self.prices = np.where(known, metadata.attributes['price'][rows], np.nan)
+        self.in_stock = self._pack(known & (metadata.attributes['stock'][rows] > 0))
+        self.known_categories = set(np.unique(self.category_ids[known]).tolist())
+        self.nothing = self._pack(np.zeros(self.size, dtype=bool))
+        self._categories = LRUCache(FILTER_CATEGORY_CACHE_SIZE)
+
+    @staticmethod
+    def available(metadata: MetadataTable) -> bool:
+        return all(name in metadata.attributes for name in ('category_id', 'price', 'stock'))
+
+    def _pack(self, mask: np.ndarray) -> np.ndarray:
+        return np.packbits(mask, bitorder='little')
+
+    def category(self, category_id: int) -> np.ndarray:
+        if category_id not in self.known_categories:
+            return self.nothing
+        bitmap = self._categories.get(category_id)
+        if bitmap is None:
+            bitmap = self._pack(self.category_ids == category_id)
+            self._categories.put(category_id, bitmap)
+        return bitmap
+
+    def price_band(self, min_price: Optional[float], max_price: Optional[float]) -> np.ndarray:
+        # NaN prices fail both comparisons, so unknown prices never match.
+        mask = ~np.isnan(self.prices)
+        if min_price is not None:
+            mask &= self.prices >= min_price
+        if max_price is not None:
+            mask &= self.prices <= max_price
+        return self._pack(mask)
+
+    def build(self, category_id: Optional[int] = None, min_price: Optional[float] = None,
+              max_price: Optional[float] = None, in_stock: bool = False) -> Optional[np.ndarray]:
+        bitmaps = []
+        if category_id is not None:
+            bitmaps.append(self.category(category_id))
+        if min_price is not None or max_price is not None:
+            bitmaps.append(self.price_band(min_price, max_price))
+        if in_stock:
+            bitmaps.append(self.in_stock)
+
+        if not bitmaps:
+            return None
+        return np.bitwise_and.reduce(bitmaps)
+
+    def count(self, bitmap: np.ndarray) -> int:
+        return int(np.unpackbits(bitmap, bitorder='little', count=self.size).sum())
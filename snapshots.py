@@ -0,0 +1,171 @@
+import os
+import json
+import shutil
+import hashlib
+from datetime import datetime, timezone
+from typing import List, Dict, Any, Optional
+from config import (
+    INDEX_ROOT, INDEX_KEEP_VERSIONS, FAISS_INDEX_PATH, METADATA_PATH, METADATA_DIR,
+    PRODUCT_INDEX_PATH, INDEX_PARAMS_PATH, INDEX_STATE_PATH
+)
+
+# Versioned index snapshots. Every build writes a new directory under
+# INDEX_ROOT holding the index, metadata, product centroids and parameters,
+# plus a manifest with checksums. CURRENT names the live version, so a
+# rollback is a pointer flip. Builds are assembled in a .tmp directory and
+# renamed, so a version directory is always complete.
+
+MANIFEST_FILE = "manifest.json"
+CURRENT_FILE = "CURRENT"
+
+class Snapshot:
+    def __init__(self, path: str, manifest: Optional[Dict[str, Any]] = None):
+        self.path = path
+        self.version = os.path.basename(path)
+        self.index_path = os.path.join(path, "index.bin")
+        self.metadata_dir = os.path.join(path, "metadata")
+        self.legacy_metadata_path = None
+        self.product_index_path = os.path.join(path, "product_index.bin")
+        self.params_path = os.path.join(path, "index_params.json")
+        self.manifest = manifest if manifest is not None else self._read_manifest()
+
+    @classmethod
+    def legacy(cls) -> 'Snapshot':
+        # The fixed paths written before snapshots existed.
+        state = {}
+        if os.path.exists(INDEX_STATE_PATH):
+            with open(INDEX_STATE_PATH, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+
+        snapshot = cls(os.path.dirname(FAISS_INDEX_PATH) or '.', manifest=state)
+        snapshot.version = None
+        snapshot.index_path = FAISS_INDEX_PATH
+        snapshot.metadata_dir = METADATA_DIR
+        snapshot.legacy_metadata_path = METADATA_PATH
+        snapshot.product_index_path = PRODUCT_INDEX_PATH
+        snapshot.params_path = INDEX_PARAMS_PATH
+        return snapshot
+
+    def _read_manifest(self) -> Dict[str, Any]:
+        path = os.path.join(self.path, MANIFEST_FILE)
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def exists(self) -> bool:
+        return os.path.exists(self.index_path)
+
+    def files(self) -> List[str]:
+        paths = []
+        for dirpath, _, filenames in os.walk(self.path):
+            for name in filenames:
+                if name != MANIFEST_FILE:
+                    paths.append(os.path.relpath(os.path.join(dirpath, name), self.path))
+        return sorted(paths)
+
+    def link_from(self, other: 'Snapshot', names: List[str]) -> Dict[str, str]:
+        # Unchanged files are hard-linked from the previous version, not copied;
+        # their known checksums are returned so publish() need not rehash them.
+        checksums = {}
+        for name in names:
+            source = os.path.join(other.path, name)
+            if os.path.exists(source):
+                os.link(source, os.path.join(self.path, name))
+                if name in other.manifest.get('checksums', {}):
+                    checksums[name] = other.manifest['checksums'][name]
+        return checksums
+
+    def verify(self, full: bool = False):
+        # By default only presence and size, which costs a stat per file; full
+        # rehashes every file, reading the whole index.
+        checksums = self.manifest.get('checksums')
+        if not checksums:
+            return
+        sizes = self.manifest.get('sizes', {})
+        for name, digest in checksums.items():
+            path = os.path.join(self.path, name)
+            if not os.path.exists(path):
+                raise ValueError(f"Missing {name} in index version {self.version}")
+            if name in sizes and os.path.getsize(path) != sizes[name]:
+                raise ValueError(f"Size mismatch for {name} in index version {self.version}")
+            if full and file_sha256(path) != digest:
+                raise ValueError(f"Checksum mismatch for {name} in index version {self.version}")
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def versions(root: str = INDEX_ROOT) -> List[Snapshot]:
+    if not os.path.isdir(root):
+        return []
+    snapshots = [
+        Snapshot(os.path.join(root, name)) for name in os.listdir(root)
+        if not name.endswith('.tmp') and os.path.exists(os.path.join(root, name, MANIFEST_FILE))
+    ]
+    return sorted(snapshots, key=lambda snapshot: snapshot.version)
+
+def current_version(root: str = INDEX_ROOT) -> Optional[str]:
+    path = os.path.join(root, CURRENT_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read().strip() or None
+
+def set_current(version: str, root: str = INDEX_ROOT):
+    if not os.path.exists(os.path.join(root, version, MANIFEST_FILE)):
+        raise ValueError(f"Unknown index version '{version}'")
+    tmp_path = os.path.join(root, CURRENT_FILE + ".tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(version + '\n')
+    os.replace(tmp_path, os.path.join(root, CURRENT_FILE))
+
+def resolve(version: Optional[str] = None, root: str = INDEX_ROOT) -> Snapshot:
+    # A named version, else CURRENT, else the pre-snapshot fixed paths.
+    version = version or current_version(root)
+    if version is None:
+        return Snapshot.legacy()
+
+    snapshot = Snapshot(os.path.join(root, version))
+    if not snapshot.manifest:
+        raise FileNotFoundError(f"Index version '{version}' not found in {root}")
+    return snapshot
+
+def create(root: str = INDEX_ROOT) -> Snapshot:
+    version = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')
+    path = os.path.join(root, version + '.tmp')
+    os.makedirs(path)
+    snapshot = Snapshot(path, manifest={})
+    snapshot.version = version
+    return snapshot
+
+def publish(snapshot: Snapshot, manifest: Dict[str, Any], known_checksums: Optional[Dict[str, str]] = None,
+            root: str = INDEX_ROOT, keep: int = INDEX_KEEP_VERSIONS) -> Snapshot:
+    known_checksums = known_checksums or {}
+    manifest = dict(manifest)
+    manifest['version'] = snapshot.version
+    manifest['built_at'] = datetime.now(timezone.utc).isoformat()
+    manifest['checksums'] = {
+        name: known_checksums.get(name) or file_sha256(os.path.join(snapshot.path, name))
+        for name in snapshot.files()
+    }
+    manifest['sizes'] = {name: os.path.getsize(os.path.join(snapshot.path, name)) for name in snapshot.files()}
+    with open(os.path.join(snapshot.path, MANIFEST_FILE), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+
+    final_path = os.path.join(root, snapshot.version)
+    os.replace(snapshot.path, final_path)
+    set_current(snapshot.version, root)
+    prune(root, keep)
+    return Snapshot(final_path)
+
+def prune(root: str = INDEX_ROOT, keep: int = INDEX_KEEP_VERSIONS):
+    # Old versions beyond `keep` are removed; the live one never is. Workers
+    # that still map a removed version keep reading it until they reload.
+    current = current_version(root)
+    old = [snapshot for snapshot in versions(root) if snapshot.version != current]
+    for snapshot in old[:max(0, len(old) - max(keep - 1, 0))]:
+        shutil.rmtree(snapshot.path, ignore_errors=True)
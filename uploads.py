@@ -0,0 +1,95 @@
+import tarfile
+import zipfile
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+from fastapi import HTTPException
+
+# Reading query images from request bodies. UploadLimitMiddleware caps the
+# body size per endpoint while it streams in, before multipart parsing. For
+# multi-image uploads every file is either one image or a zip / tar
+# (optionally compressed) archive of images; archives are read member by
+# member from the spooled upload, never fully in memory.
+
+class UploadLimitMiddleware:
+    def __init__(self, app, limits: Dict[str, int]):
+        self.app = app
+        self.limits = limits
+
+    async def __call__(self, scope, receive, send):
+        limit = self.limits.get(scope.get('path')) if scope['type'] == 'http' else None
+        if limit is None:
+            return await self.app(scope, receive, send)
+
+        # A declared length over the cap is refused without reading the body.
+        headers = dict(scope.get('headers') or [])
+        length = headers.get(b'content-length', b'')
+        if length.isdigit() and int(length) > limit:
+            await send({'type': 'http.response.start', 'status': 413,
+                        'headers': [(b'content-type', b'application/json')]})
+            await send({'type': 'http.response.body',
+                        'body': f'{{"detail":"Upload is larger than {limit} bytes"}}'.encode('utf-8')})
+            return
+
+        # Chunked or understated bodies are cut off once they pass the cap;
+        # the HTTPException surfaces from request.form() as a 413.
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > limit:
+                    raise HTTPException(status_code=413, detail=f"Upload is larger than {limit} bytes")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+def _is_hidden(name: str) -> bool:
+    # Skips macOS resource forks (__MACOSX/._x.jpg) and other dot files.
+    return any(part.startswith('.') or part == '__MACOSX' for part in name.split('/'))
+
+def _read_capped(member: BinaryIO, max_bytes: int) -> Optional[bytes]:
+    # Reads at most max_bytes + 1, so a compression bomb is never inflated.
+    data = member.read(max_bytes + 1)
+    return data if len(data) <= max_bytes else None
+
+def _archive_members(f: BinaryIO, max_bytes: int) -> Iterator[Tuple[str, Optional[bytes]]]:
+    f.seek(0)
+    if zipfile.is_zipfile(f):
+        f.seek(0)
+        with zipfile.ZipFile(f) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and not _is_hidden(info.filename):
+                    with archive.open(info) as member:
+                        yield info.filename, _read_capped(member, max_bytes)
+        return
+
+    f.seek(0)
+    with tarfile.open(fileobj=f, mode='r:*') as archive:
+        for member in archive:
+            if member.isfile() and not _is_hidden(member.name):
+                yield member.name, _read_capped(archive.extractfile(member), max_bytes)
+
+def is_archive(f: BinaryIO) -> bool:
+    f.seek(0)
+    if zipfile.is_zipfile(f):
+        return True
+    f.seek(0)
+    try:
+        with tarfile.open(fileobj=f, mode='r:*'):
+            return True
+    except (tarfile.TarError, EOFError):
+        return False
+    finally:
+        f.seek(0)
+
+def iter_query_images(files: List[Tuple[str, BinaryIO]], max_bytes: int) -> Iterator[Tuple[str, Optional[bytes]]]:
+    # (name, bytes) of every query image; archive members are named
+    # "<archive>/<member>" and images over max_bytes come back as None.
+    for filename, f in files:
+        if is_archive(f):
+            for name, data in _archive_members(f, max_bytes):
+                yield f"{filename}/{name}", data
+        else:
+            f.seek(0)
+            yield filename, _read_capped(f, max_bytes)
@@ -0,0 +1,113 @@
+import asyncio
+import ipaddress
+import httpx
+from urllib.parse import urlparse
+from typing import List, Optional
+from config import (
+    URL_FETCH_TIMEOUT, URL_FETCH_MAX_BYTES, URL_FETCH_MAX_CONNECTIONS, URL_FETCH_ALLOWED_HOSTS,
+    URL_FETCH_ALLOW_PRIVATE, URL_FETCH_MAX_REDIRECTS
+)
+
+# Query images fetched by the service itself for /search/url. One pooled
+# keep-alive AsyncClient is shared by all requests; every download is
+# streamed and aborted as soon as it exceeds max_bytes or the deadline, and
+# every redirect hop must pass the same host checks as the first URL. The
+# connection goes to the address that was checked (Host header and TLS SNI
+# keep the name), so DNS cannot point it elsewhere after the check.
+
+class FetchError(ValueError):
+    pass
+
+def is_public(address: str) -> bool:
+    address = ipaddress.ip_address(address.split('%')[0])
+    return address.is_global and not address.is_multicast
+
+class ImageFetcher:
+    def __init__(self, timeout: float = URL_FETCH_TIMEOUT, max_bytes: int = URL_FETCH_MAX_BYTES,
+                 max_connections: int = URL_FETCH_MAX_CONNECTIONS, allowed_hosts: List[str] = URL_FETCH_ALLOWED_HOSTS,
+                 allow_private: bool = URL_FETCH_ALLOW_PRIVATE, max_redirects: int = URL_FETCH_MAX_REDIRECTS):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.max_connections = max_connections
+        self.allowed_hosts = allowed_hosts
+        self.allow_private = allow_private
+        self.max_redirects = max_redirects
+        self.client: Optional[httpx.AsyncClient] = None
+
+    def _client(self) -> httpx.AsyncClient:
+        if self.client is None:
+            # Redirects are followed by hand so every hop is checked.
+            self.client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout),
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections),
+                follow_redirects=False
+            )
+        return self.client
+
+    async def check_url(self, url: str) -> Optional[str]:
+        # Returns the checked address to connect to, or None when private
+        # addresses are allowed and the client resolves the name itself.
+        parsed = urlparse(url)
+        if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+            raise FetchError(f"Not an http(s) URL: {url}")
+        if self.allowed_hosts and parsed.hostname not in self.allowed_hosts:
+            raise FetchError(f"Host {parsed.hostname} is not allowed")
+        if self.allow_private:
+            return None
+
+        # Loopback, private, link-local (cloud metadata) and other non-public
+        # addresses are refused, whatever name points at them.
+        port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        try:
+            infos = await asyncio.get_running_loop().getaddrinfo(parsed.hostname, port)
+        except OSError as e:
+            raise FetchError(f"Cannot resolve {parsed.hostname}: {e}")
+        addresses = [info[4][0] for info in infos]
+        if not addresses or not all(is_public(address) for address in addresses):
+            raise FetchError(f"Host {parsed.hostname} resolves to a non-public address")
+        return addresses[0].split('%')[0]
+
+    async def fetch(self, url: str) -> bytes:
+        # One deadline for the whole download, redirects included: the
+        # client timeout alone is per read and a server trickling bytes
+        # under the size cap would never hit it.
+        try:
+            return await asyncio.wait_for(self._fetch(url), self.timeout)
+        except asyncio.TimeoutError:
+            raise FetchError(f"Download took longer than {self.timeout}s")
+
+    async def _fetch(self, url: str) -> bytes:
+        for _ in range(self.max_redirects + 1):
+            address = await self.check_url(url)
+            target = httpx.URL(url)
+            headers, extensions = {}, {}
+            if address is not None:
+                headers['Host'] = target.netloc.decode('ascii')
+                extensions['sni_hostname'] = target.host
+                target = target.copy_with(host=address)
+            try:
+                async with self._client().stream('GET', target, headers=headers, extensions=extensions) as response:
+                    if response.is_redirect:
+                        url = str(httpx.URL(url).join(response.headers['Location']))
+                        continue
+                    if response.status_code != 200:
+                        raise FetchError(f"HTTP {response.status_code} from {url}")
+                    length = response.headers.get('Content-Length')
+                    if length and length.isdigit() and int(length) > self.max_bytes:
+                        raise FetchError(f"Image is larger than {self.max_bytes} bytes")
+
+                    data = bytearray()
+                    async for chunk in response.aiter_bytes():
+                        data += chunk
+                        if len(data) > self.max_bytes:
+                            raise FetchError(f"Image is larger than {self.max_bytes} bytes")
+                    return bytes(data)
+            except httpx.HTTPError as e:
+                raise FetchError(f"Download failed: {e.__class__.__name__}: {e}")
+        raise FetchError(f"More than {self.max_redirects} redirects")
+
+    async def aclose(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None